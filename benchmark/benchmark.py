@@ -0,0 +1,292 @@
+"""
+Headless load generator and benchmark for the distributed file system.
+
+The benchmark starts a naming server and a number of storage servers on loopback, each in its own temporary
+directory, and drives them through the client's own functions with many concurrent simulated users. Every user
+repeatedly picks an operation from a weighted mix and, for uploads and downloads, one of its files of the
+configured sizes:
+- put: locate the file and upload it to its replicas (write quorum),
+- get: locate the file and download it from the fastest replica,
+- list: list the user's files on every alive storage server,
+- query: ask the naming server where a file lives, bypassing the client's location cache.
+Every user uploads all its files once before measuring starts, so downloads always find them.
+
+The result is printed as JSON (or written to --output): for each operation and in total, the operation count,
+errors, ops/s, bytes/s and p50/p99/p999/max latency in milliseconds, plus the configuration that produced it,
+so runs of different server modes or commits can be compared side by side.
+
+Usage:
+    python benchmark.py --storage-servers 3 --users 32 --duration 10 --mix put=20,get=60,list=10,query=10 \\
+        --sizes 1KiB,64KiB,1MiB --mode async
+"""
+
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY, 'client'))
+
+import client
+
+NAMING_SERVER = os.path.join(REPOSITORY, 'servers', 'server.py')
+STORAGE_SERVER = os.path.join(REPOSITORY, 'servers', 'storage server', 'storage_server.py')
+HOST = '127.0.0.1'
+STARTUP_TIMEOUT = 15.0  # seconds to wait for every storage server to register
+UNITS = {'B': 1, 'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3}
+OPERATIONS = ('put', 'get', 'list', 'query')
+
+def parse_size(text):
+    """ Parse a size such as '4096', '64KiB' or '1MB' into bytes. """
+    text = text.strip().upper()
+    for unit in sorted(UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * UNITS[unit])
+    return int(text)
+
+def parse_mix(text):
+    """ Parse 'put=20,get=60' into operation weights. """
+    mix = {}
+    for part in text.split(','):
+        operation, weight = part.split('=')
+        if operation.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {operation}; choose from {', '.join(OPERATIONS)}")
+        mix[operation.strip()] = float(weight)
+    return mix
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+def start_cluster(args, directory):
+    """ Start the naming server and the storage servers; return their processes and the naming server port. """
+    processes = []
+    naming_port = free_port()
+    with open(os.path.join(directory, 'naming_server.log'), 'w') as log:
+        processes.append(subprocess.Popen(
+            [sys.executable, NAMING_SERVER, HOST, str(naming_port), '--mode', args.mode, '--no-persist',
+             '--replicas', str(args.replicas), '--heartbeat-timeout', str(args.heartbeat_interval * 3)],
+            cwd=directory, stdout=log, stderr=subprocess.STDOUT))
+    wait_for_port(naming_port)
+    for index in range(args.storage_servers):
+        server_directory = os.path.join(directory, f'storage{index}')
+        os.makedirs(server_directory)
+        with open(os.path.join(directory, f'storage{index}.log'), 'w') as log:
+            processes.append(subprocess.Popen(
+                [sys.executable, STORAGE_SERVER, HOST, str(free_port()), HOST, str(naming_port), '--mode', args.mode,
+                 '--backend', args.backend, '--heartbeat-interval', str(args.heartbeat_interval)],
+                cwd=server_directory, stdout=log, stderr=subprocess.STDOUT))
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        info = client.contact_naming_server_for_info('', HOST, naming_port)
+        if info and len(info.get('servers', [])) == args.storage_servers:
+            return processes, naming_port
+        time.sleep(0.1)
+    stop_cluster(processes)
+    raise RuntimeError(f"Storage servers did not register within {STARTUP_TIMEOUT} seconds; see the logs in {directory}")
+
+def wait_for_port(port):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+def stop_cluster(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def create_payloads(args):
+    """
+    Write one payload file per size in the current directory and give every user its own
+    names for them (hard links where possible), so concurrent downloads never share a file.
+    Returns {username: [(filename, size), ...]}.
+    """
+    files = {}
+    for size in args.sizes:
+        with open(f'payload-{size}', 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                chunk = min(remaining, client.CHUNK_SIZE)
+                f.write(os.urandom(chunk) if args.content == 'random' else (b'benchmark text payload\n' * (chunk // 23 + 1))[:chunk])
+                remaining -= chunk
+    for user in range(args.users):
+        username = f'bench{user}'
+        files[username] = []
+        for size in args.sizes:
+            for copy in range(args.files_per_size):
+                filename = f'{username}-{size}-{copy}.dat'
+                try:
+                    os.link(f'payload-{size}', filename)
+                except OSError:
+                    shutil.copyfile(f'payload-{size}', filename)
+                files[username].append((filename, size))
+    return files
+
+def run_operation(operation, username, filename, naming_port):
+    """ Perform one operation as the given user; return (succeeded, bytes moved). """
+    if operation == 'query':
+        return client.contact_naming_server_for_info(filename, HOST, naming_port, username) is not None, 0
+    if operation == 'list':
+        info = client.locate_file('', HOST, naming_port)[0]
+        if not info or not info.get('servers'):
+            return False, 0
+        return all(client.list_all_files(server, username) is not None for server in info['servers']), 0
+    info = client.locate_file(filename, HOST, naming_port, username)[0]
+    size = os.path.getsize(filename)
+    if operation == 'put':
+        stored = bool(info and info.get('replicas')) and client.store_file_on_replicas(info['replicas'], filename, username,
+                                                                                        HOST, naming_port)
+        return stored, size
+    return bool(info and info.get('servers')) and client.fetch_file_from_replicas(info['servers'], filename, username), size
+
+class Recorder:
+    """ Collects the latency of every operation, per operation type. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = dict.fromkeys(OPERATIONS, 0)
+        self.bytes = dict.fromkeys(OPERATIONS, 0)
+
+    def record(self, operation, seconds, succeeded, size):
+        with self.lock:
+            if succeeded:
+                self.latencies[operation].append(seconds)
+                self.bytes[operation] += size
+            else:
+                self.errors[operation] += 1
+
+def percentile(ordered, fraction):
+    """ Nearest-rank percentile of an ascending list, in milliseconds. """
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+def summarize(latencies, errors, size, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'operations': len(ordered),
+        'errors': errors,
+        'ops_per_second': round(len(ordered) / elapsed, 2),
+        'bytes_per_second': round(size / elapsed),
+        'latency_ms': {'p50': percentile(ordered, 0.5), 'p99': percentile(ordered, 0.99),
+                       'p999': percentile(ordered, 0.999), 'max': percentile(ordered, 1.0)},
+    }
+
+def user_loop(username, files, args, naming_port, recorder, stop, rng):
+    operations = list(args.mix)
+    weights = [args.mix[operation] for operation in operations]
+    while not stop.is_set():
+        operation = rng.choices(operations, weights)[0]
+        filename = rng.choice(files)[0]
+        started = time.perf_counter()
+        try:
+            succeeded, size = run_operation(operation, username, filename, naming_port)
+        except Exception:
+            succeeded, size = False, 0
+        recorder.record(operation, time.perf_counter() - started, succeeded, size)
+
+def run_benchmark(args):
+    directory = tempfile.mkdtemp(prefix='dfs-benchmark-')
+    processes = []
+    previous_directory = os.getcwd()
+    try:
+        processes, naming_port = start_cluster(args, directory)
+        os.makedirs(os.path.join(directory, 'client'))
+        # The client names remote files after their local paths, so work with bare names in one directory
+        os.chdir(os.path.join(directory, 'client'))
+        client.pool.max_idle = args.users
+        if args.no_location_cache:
+            client.location_cache.capacity = 0
+        files = create_payloads(args)
+        recorder = Recorder()
+        stop = threading.Event()
+        # Warm up: every file exists before anything is read
+        for username, user_files in files.items():
+            for filename, size in user_files:
+                run_operation('put', username, filename, naming_port)
+        rng = random.Random(args.seed)
+        users = [threading.Thread(target=user_loop, daemon=True,
+                                  args=(username, user_files, args, naming_port, recorder, stop,
+                                        random.Random(rng.random())))
+                 for username, user_files in files.items()]
+        started = time.perf_counter()
+        for user in users:
+            user.start()
+        time.sleep(args.duration)
+        stop.set()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(previous_directory)
+        stop_cluster(processes)
+        if args.keep:
+            print(f"Benchmark files and server logs kept in {directory}", file=sys.stderr)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    all_latencies = [latency for operation in args.mix for latency in recorder.latencies[operation]]
+    return {
+        'config': {'storage_servers': args.storage_servers, 'mode': args.mode, 'backend': args.backend,
+                   'replicas': args.replicas, 'users': args.users, 'duration': args.duration, 'mix': args.mix,
+                   'sizes': args.sizes, 'files_per_size': args.files_per_size, 'content': args.content,
+                   'location_cache': not args.no_location_cache, 'seed': args.seed},
+        'elapsed_seconds': round(elapsed, 3),
+        'operations': {operation: summarize(recorder.latencies[operation], recorder.errors[operation],
+                                            recorder.bytes[operation], elapsed) for operation in args.mix},
+        'total': summarize(all_latencies, sum(recorder.errors.values()), sum(recorder.bytes.values()), elapsed),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a local distributed file system cluster")
+    parser.add_argument('--storage-servers', type=int, default=3, help="storage servers to start")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded', help="mode of every server")
+    parser.add_argument('--backend', choices=['files', 'blocks'], default='files', help="storage server backend")
+    parser.add_argument('--replicas', type=int, default=3, help="replication factor of the naming server")
+    parser.add_argument('--users', type=int, default=16, help="concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to measure for")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('put=20,get=60,list=10,query=10'),
+                        help="operation weights, e.g. put=20,get=60,list=10,query=10")
+    parser.add_argument('--sizes', type=lambda text: [parse_size(size) for size in text.split(',')],
+                        default=[1024, 64 * 1024, 1024 * 1024], help="file sizes, e.g. 1KiB,64KiB,1MiB")
+    parser.add_argument('--files-per-size', type=int, default=2, help="files of each size per user")
+    parser.add_argument('--content', choices=['random', 'text'], default='random',
+                        help="file contents: incompressible random bytes or compressible text")
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0, help="storage server heartbeat interval")
+    parser.add_argument('--no-location-cache', action='store_true',
+                        help="ask the naming server before every operation instead of reusing leased locations")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the operation and file choices")
+    parser.add_argument('--output', help="write the JSON report to this file instead of standard output")
+    parser.add_argument('--keep', action='store_true', help="keep the cluster's files and logs after the run")
+    args = parser.parse_args()
+
+    output = sys.stdout
+    # The client reports every transfer on standard output; keep the report the only thing printed there
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        report = json.dumps(run_benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report, file=output)
@@ -1,89 +1,910 @@
 import socket
 import json
+import os
+import struct
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import mysql.connector
+import mysql.connector.pooling
 from mysql.connector import Error
 import hashlib
+import tempfile
+import zlib
 import getpass
 from colorama import init, Fore, Style
 
+# The compression codecs are shared with the storage server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'servers', 'common'))
+from compressors import CODECS
+
 init(autoreset=True)
 
-def contact_naming_server_for_info(filename, naming_server_host, naming_server_port):
+HEADER_PREFIX = struct.Struct('!I')  # 4-byte big-endian length of the JSON header
+CHUNK_SIZE = 64 * 1024  # bytes moved per read/write while streaming a body
+MAX_IDLE_CONNECTIONS = 4  # idle sockets kept open per server
+LATENCY_WEIGHT = 0.3  # weight of the newest sample in each server's moving-average latency
+FAILURE_BACKOFF = 30.0  # seconds a storage server that failed a request is tried after the others
+BLOCK_SIZE = 1024 * 1024  # bytes per block for deduplicated uploads
+PIPELINE_DEPTH = 16  # blocks sent before waiting for their acknowledgements
+STRIPE_SIZE = 8 * 1024 * 1024  # bytes per stripe of a striped file
+STRIPE_THRESHOLD = 64 * 1024 * 1024  # files at least this large are striped over several servers
+STRIPE_WORKERS = 8  # stripes transferred at once
+LOCATION_CACHE_SIZE = 4096  # naming server replies kept for reuse
+BATCH_FILES = 256  # files moved per MPUT or MGET; storage servers reject larger batches
+MIN_COMPRESS_SIZE = 4096  # smaller files are always sent as they are
+COMPRESSION_SAMPLE = 64 * 1024  # bytes test-compressed to decide whether a file is worth compressing
+COMPRESSION_RATIO = 0.9  # files whose sample does not shrink below this fraction are sent as they are
+SPOOL_SIZE = 8 * 1024 * 1024  # compressed uploads larger than this are staged on disk rather than in memory
+# Extensions of formats that are compressed already
+INCOMPRESSIBLE_EXTENSIONS = {'.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar', '.jpg', '.jpeg',
+                             '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov', '.pdf', '.docx', '.xlsx'}
+DB_POOL_SIZE = 4  # database connections kept open for registrations
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'root',  # Replace with your MySQL username
+    'password': '',  # Replace with your MySQL password
+    'database': 'comp5504_users',  # Replace with your database name
+}
+
+# Moving-average round-trip time per storage server, used to order the copies of a stripe
+server_latency = {}
+# Storage server -> when a request to it last failed
+server_failures = {}
+# Whether each storage server accepts deduplicated block uploads; unknown servers are tried once
+block_support = {}
+# Codecs each storage server accepts uploads in; asked for once per server
+codec_support = {}
+# Pool of database connections, opened on first use
+db_pool = None
+# Signed session token of the logged-in user, sent with every request; None when tokens are not in use
+session_token = None
+
+def recv_exact(s, size):
+    """ Read exactly size bytes from the socket. """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = s.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError("Connection closed by server")
+        received += count
+    return bytes(buffer)
+
+def send_header(s, header):
+    """ Send a length-prefixed JSON header. """
+    payload = json.dumps(header).encode()
+    s.sendall(HEADER_PREFIX.pack(len(payload)) + payload)
+
+def recv_header(s):
+    """ Receive a length-prefixed JSON header. """
+    (header_length,) = HEADER_PREFIX.unpack(recv_exact(s, HEADER_PREFIX.size))
+    return json.loads(recv_exact(s, header_length).decode())
+
+def parse_address(server_details):
+    """ Turn 'host:port' into a (host, port) tuple. """
+    host, port = server_details.rsplit(':', 1)
+    return host, int(port)
+
+class PooledConnection:
+    """
+    A persistent connection to one server. Several requests may be sent before any reply
+    is read; replies carry the request id and are matched back to their requests.
+    Replies followed by a body (GET) must be read in the order the requests were sent.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.create_connection(address)
+        # A header and its body go out as separate writes; don't let Nagle hold the second back for an ACK
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.next_id = 0
+        self.pending = {}
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, header):
+        """ Send a request header, with the session token once logged in, and return its id. """
+        self.next_id += 1
+        if session_token is not None:
+            header = dict(header, token=session_token)
+        send_header(self.sock, dict(header, id=self.next_id))
+        return self.next_id
+
+    def receive(self, request_id):
+        """ Return the reply to request_id, holding on to replies for other requests. """
+        while request_id not in self.pending:
+            response = recv_header(self.sock)
+            if response.get('id') != request_id and response.get('length'):
+                raise ConnectionError("Reply with a body arrived out of order")
+            self.pending[response.get('id')] = response
+        return self.pending.pop(request_id)
+
+    def request(self, header):
+        return self.receive(self.send(header))
+
+class ConnectionPool:
+    """ Keeps idle connections to the naming server and storage servers open for reuse. """
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, address):
+        """ Return (connection, reused): an idle connection if one exists, else a new one. """
+        with self.lock:
+            connections = self.idle.get(address)
+            if connections:
+                return connections.pop(), True
+        return PooledConnection(address), False
+
+    def release(self, connection):
+        with self.lock:
+            connections = self.idle.setdefault(connection.address, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def run(self, address, operation):
+        """
+        Call operation(connection) on a pooled connection to address. If a reused connection
+        turns out to have been closed by the server, retry once on a fresh one.
+        """
+        connection, reused = self.acquire(address)
+        try:
+            result = operation(connection)
+        except (ConnectionError, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            connection = PooledConnection(address)
+            try:
+                result = operation(connection)
+            except Exception:
+                connection.close()
+                raise
+        except Exception:
+            connection.close()
+            raise
+        self.release(connection)
+        return result
+
+    def close_all(self):
+        """ Close every idle connection, say when a session ends. """
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+pool = ConnectionPool()
+
+class LocationCache:
+    """
+    An LRU cache of naming server query replies. Each reply is reused until the lease the
+    naming server granted with it runs out. Replies also carry the placement epoch; once any
+    reply shows a different epoch, servers have joined, failed or come back since the cached
+    replies were made, so all of them are dropped.
+    """
+
+    def __init__(self, capacity=LOCATION_CACHE_SIZE):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (lease expiry, reply)
+        self.epoch = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def observe(self, reply):
+        """ Note the placement epoch of any naming server reply. """
+        epoch = reply.get('epoch')
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                self.entries.clear()
+                self.epoch = epoch
+
+    def put(self, key, reply):
+        self.observe(reply)
+        lease = reply.get('lease', 0)
+        if lease <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + lease, reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, filename, username):
+        """ Forget every cached reply about a user's file. """
+        with self.lock:
+            for key in [key for key in self.entries if key[2:4] == (username, filename)]:
+                del self.entries[key]
+
+location_cache = LocationCache()
+
+def contact_naming_server_for_info(filename, naming_server_host, naming_server_port, username='', stripe=False):
+    """
+    Ask the naming server where a user's file lives. The first server in the reply owns
+    the file; with an empty filename every alive server is returned. With stripe set the
+    reply also lists the servers to spread a striped upload over.
+    """
+    request = {'type': 'query', 'filename': filename, 'username': username}
+    if stripe:
+        request['stripe'] = True
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((naming_server_host, naming_server_port))
-            request = json.dumps({'type': 'query', 'filename': filename})
-            s.sendall(request.encode())
-            response = json.loads(s.recv(1024).decode())
-            return response
+        response = pool.run((naming_server_host, naming_server_port), lambda conn: conn.request(request))
     except json.JSONDecodeError:
         print(Fore.RED + "Error decoding the response from naming server.")
         return None
     except Exception as e:
         print(Fore.RED + f"Failed to contact naming server: {e}")
         return None
+    location_cache.put((naming_server_host, naming_server_port, username, filename, stripe), response)
+    return response
 
-def send_file_to_storage_server(server_details, filename, content,username):
-    server_ip, server_port = server_details.split(':')
+def locate_file(filename, naming_server_host, naming_server_port, username='', stripe=False):
+    """
+    Like contact_naming_server_for_info, but answered from the location cache while a lease
+    is held. Returns (reply, cached) so callers can retry with fresh locations when cached
+    ones turn out to be stale.
+    """
+    response = location_cache.get((naming_server_host, naming_server_port, username, filename, stripe))
+    if response is not None:
+        return response, True
+    return contact_naming_server_for_info(filename, naming_server_host, naming_server_port, username, stripe), False
+
+def locate_files(filenames, naming_server_host, naming_server_port, username):
+    """
+    Locate many files with at most one naming server round trip: cached replies are reused and
+    the rest are asked for in a single batch query. Returns a dict of filename -> query reply.
+    """
+    located = {}
+    for filename in filenames:
+        response = location_cache.get((naming_server_host, naming_server_port, username, filename, False))
+        if response is not None:
+            located[filename] = response
+    missing = [filename for filename in filenames if filename not in located]
+    if not missing:
+        return located
+    request = {'type': 'query', 'filenames': missing, 'username': username}
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((server_ip, int(server_port)))
-            message = f"PUT|{filename}|{content}|{username}"
-            s.sendall(message.encode())
-            
-            print(Fore.GREEN +"File stored successfully")
+        response = pool.run((naming_server_host, naming_server_port), lambda conn: conn.request(request))
     except Exception as e:
-        print(Fore.RED + f"Error sending file to storage server: {e}")
+        print(Fore.RED + f"Failed to contact naming server: {e}")
+        return located
+    for filename, file_response in response.get('files', {}).items():
+        location_cache.put((naming_server_host, naming_server_port, username, filename, False), file_response)
+        located[filename] = file_response
+    return located
 
-def get_file_from_storage_server(server_details, filename,username):
-    server_ip, server_port = server_details.split(':')
+def record_latency(server_details, seconds):
+    """ Fold one observed round trip into the server's moving-average latency. """
+    previous = server_latency.get(server_details)
+    server_latency[server_details] = seconds if previous is None else (1 - LATENCY_WEIGHT) * previous + LATENCY_WEIGHT * seconds
+
+def record_failure(server_details):
+    server_failures[server_details] = time.monotonic()
+
+def recently_failed(server_details):
+    failed = server_failures.get(server_details)
+    return failed is not None and time.monotonic() - failed < FAILURE_BACKOFF
+
+def rank_replicas(servers, ranked=True):
+    """
+    Order replicas to try. The naming server ranks the servers in a query reply by their reported
+    load, and that order is kept, except that servers that failed us recently go last. Lists it did
+    not rank (the copies of a stripe, with ranked unset) are ordered fastest first by our own
+    latency measurements; servers not timed yet go first so they get measured.
+    """
+    if ranked:
+        return sorted(servers, key=recently_failed)
+    return sorted(servers, key=lambda server: (recently_failed(server), server_latency.get(server, 0.0)))
+
+def send_from_file(s, f, length):
+    """ Stream the next length bytes of an open binary file to the socket. """
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(CHUNK_SIZE, remaining))
+        if not chunk:
+            raise IOError("File shrank while it was being sent")
+        s.sendall(chunk)
+        remaining -= len(chunk)
+
+def server_codecs(server_details):
+    """ The codecs a storage server accepts compressed uploads in; servers that predate compression accept none. """
+    if server_details not in codec_support:
+        response = pool.run(parse_address(server_details), lambda conn: conn.request({'op': 'CODECS', 'length': 0}))
+        codec_support[server_details] = response.get('codecs', []) if response.get('status') == 'OK' else []
+    return codec_support[server_details]
+
+def worth_compressing(filename):
+    """
+    Whether a file is worth uploading compressed: small files, formats that are compressed
+    already, and files whose first bytes barely compress are not.
+    """
+    if os.path.getsize(filename) < MIN_COMPRESS_SIZE:
+        return False
+    if os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    with open(filename, 'rb') as f:
+        sample = f.read(COMPRESSION_SAMPLE)
+    return len(zlib.compress(sample, 1)) < COMPRESSION_RATIO * len(sample)
+
+def compress_file(filename, codec):
+    """
+    Compress a file chunk by chunk. Return the compressed bytes, or, once they outgrow SPOOL_SIZE,
+    the path of a temporary file holding them, which the caller removes.
+    """
+    compressor = CODECS[codec][0]()
+    compressed = bytearray()
+    spill = path = None
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((server_ip, int(server_port)))
-            message = f"GET|{filename}||{username}"
-            s.sendall(message.encode())
-            response = s.recv(1024).decode()
-     
-            if response == 'FILE_IS_EMPTY':
-                print(Fore.MAGENTA +"YOUR FILE DOES NOT HAVE CONTENT")
-            else:
-                with open(f'{filename}', 'w') as f:
-                    f.write(response)
-                    f.close()
-                print(Fore.GREEN +"File saved successfully!")
-                print(Fore.RESET +"File content:\n", response)
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                data = compressor.compress(chunk) if chunk else compressor.flush()
+                if spill is None and len(compressed) + len(data) > SPOOL_SIZE:
+                    fd, path = tempfile.mkstemp(prefix='dfs-upload-')
+                    spill = os.fdopen(fd, 'wb')
+                    spill.write(compressed)
+                if spill is None:
+                    compressed += data
+                else:
+                    spill.write(data)
+                if not chunk:
+                    break
+    except BaseException:
+        if spill is not None:
+            spill.close()
+            os.remove(path)
+        raise
+    if spill is None:
+        return compressed
+    spill.close()
+    return path
+
+class UploadBodies:
+    """
+    What one upload sends, shared by the uploads to all of its replicas: whether the file is worth
+    compressing is decided once, and it is compressed at most once per codec. Bodies too large to
+    keep in memory are staged in temporary files that every upload opens for itself, so replicas
+    can be sent to at the same time. The last of the given number of users to release the bodies
+    removes those files.
+    """
+
+    def __init__(self, filename, users=1):
+        self.filename = filename
+        self.users = users
+        self.compressible = None
+        self.bodies = {}  # codec -> compressed bytes, or the path of a temporary file holding them
+        self.lock = threading.Lock()
+
+    def choose_codec(self, codecs):
+        """ The codec to upload the file in to a server accepting codecs, or None to send it as it is. """
+        codec = next((codec for codec in CODECS if codec in codecs), None)
+        if codec is None:
+            return None
+        with self.lock:
+            if self.compressible is None:
+                self.compressible = worth_compressing(self.filename)
+        return codec if self.compressible else None
+
+    def body(self, codec):
+        with self.lock:
+            if codec not in self.bodies:
+                self.bodies[codec] = compress_file(self.filename, codec)
+            return self.bodies[codec]
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            bodies, self.bodies = self.bodies, {}
+        for body in bodies.values():
+            if isinstance(body, str):
+                os.remove(body)
+
+def send_file_to_storage_server(server_details, filename, username, bodies=None):
+    """
+    Stream a local file to one storage server without loading it into memory and return its reply.
+    The file is compressed on the way when the server accepts a codec and the content is worth it;
+    uploads to several replicas share one UploadBodies so the file is only compressed once.
+    """
+    own_bodies = bodies is None
+    if own_bodies:
+        bodies = UploadBodies(filename)
+
+    def put(conn):
+        started = time.monotonic()
+        if body is None:
+            with open(filename, 'rb') as f:
+                length = os.fstat(f.fileno()).st_size
+                request_id = conn.send({'op': 'PUT', 'filename': filename, 'username': username, 'length': length})
+                send_from_file(conn.sock, f, length)
+        elif isinstance(body, str):
+            with open(body, 'rb') as f:
+                length = os.fstat(f.fileno()).st_size
+                request_id = conn.send({'op': 'PUT', 'filename': filename, 'username': username, 'length': length,
+                                        'codec': codec, 'size': os.path.getsize(filename)})
+                send_from_file(conn.sock, f, length)
+        else:
+            request_id = conn.send({'op': 'PUT', 'filename': filename, 'username': username, 'length': len(body),
+                                    'codec': codec, 'size': os.path.getsize(filename)})
+            conn.sock.sendall(body)
+        response = conn.receive(request_id)
+        record_latency(server_details, time.monotonic() - started)
+        return response
+
+    try:
+        codec = bodies.choose_codec(server_codecs(server_details))
+        body = bodies.body(codec) if codec else None
+        return pool.run(parse_address(server_details), put)
+    finally:
+        if own_bodies:
+            bodies.release()
+
+def file_blocks(filename):
+    """ Split a local file into [digest, size] blocks, reading one block at a time. """
+    blocks = []
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                return blocks
+            blocks.append([hashlib.sha256(data).hexdigest(), len(data)])
+
+def send_file_deduplicated(server_details, filename, username):
+    """
+    Upload a file to a block-store server, sending only the blocks it does not hold yet,
+    followed by the manifest that assembles them. Returns None when the server does not
+    store blocks, so the caller can fall back to a plain PUT.
+    """
+    def upload(conn):
+        started = time.monotonic()
+        blocks = file_blocks(filename)
+        response = conn.request({'op': 'HAS_BLOCKS', 'filename': filename, 'username': username,
+                                 'blocks': [digest for digest, size in blocks]})
+        if response.get('status') != 'OK':
+            return None
+        missing = set(response['missing'])
+
+        def acknowledge(request_ids):
+            """ Wait for a batch of PUT_BLOCK replies and return the first failure, if any. """
+            for request_id in request_ids:
+                response = conn.receive(request_id)
+                if response.get('status') != 'BLOCK_STORED':
+                    return response
+            return None
+
+        in_flight = []
+        with open(filename, 'rb') as f:
+            offset = 0
+            for digest, size in blocks:
+                if digest in missing:
+                    missing.discard(digest)
+                    f.seek(offset)
+                    in_flight.append(conn.send({'op': 'PUT_BLOCK', 'block': digest, 'length': size}))
+                    conn.sock.sendall(f.read(size))
+                    # Keep a bounded number of blocks in flight so replies never back up
+                    if len(in_flight) >= PIPELINE_DEPTH:
+                        failure = acknowledge(in_flight)
+                        if failure:
+                            return failure
+                        in_flight = []
+                offset += size
+        failure = acknowledge(in_flight)
+        if failure:
+            return failure
+        response = conn.request({'op': 'PUT_MANIFEST', 'filename': filename, 'username': username, 'blocks': blocks})
+        record_latency(server_details, time.monotonic() - started)
+        return response
+
+    return pool.run(parse_address(server_details), upload)
+
+def upload_file(server_details, filename, username, bodies=None):
+    """ Upload through the block protocol where the server supports it, otherwise as a plain PUT. """
+    if block_support.get(server_details, True):
+        response = send_file_deduplicated(server_details, filename, username)
+        if response is not None:
+            block_support[server_details] = True
+            return response
+        block_support[server_details] = False
+    return send_file_to_storage_server(server_details, filename, username, bodies)
+
+def report_missed_writes(missed, username, naming_server_host, naming_server_port):
+    """
+    Tell the naming server which replicas did not store a write ({filename: [servers]}), so it stops
+    sending readers to the older copies they still hold until the rebalancer replaces them.
+    """
+    missed = {filename: servers for filename, servers in missed.items() if servers}
+    if not missed or naming_server_host is None:
+        return
+    request = {'type': 'missed', 'username': username, 'files': missed}
+    try:
+        pool.run((naming_server_host, naming_server_port), lambda conn: conn.request(request))
     except Exception as e:
-        print(Fore.RED + f"Error retrieving file from storage server: {e}")
+        print(Fore.RED + f"Failed to report replicas that missed a write to the naming server: {e}")
+
+def store_file_on_replicas(replicas, filename, username, naming_server_host=None, naming_server_port=None):
+    """
+    Upload a file to every replica at once and return as soon as a majority of them
+    (the write quorum) has stored it. Slower replicas finish in the background, and replicas
+    that end up not storing the file are reported to the naming server. The file is
+    compressed at most once, however many replicas it goes to.
+    """
+    bodies = UploadBodies(filename, len(replicas))
+
+    def store(server):
+        try:
+            response = upload_file(server, filename, username, bodies)
+        except Exception as e:
+            print(Fore.RED + f"Error sending file to storage server {server}: {e}")
+            record_failure(server)
+            return False
+        finally:
+            bodies.release()
+        if response.get('status') != 'PUT_COMPLETE':
+            print(Fore.RED + f"Storage server {server} rejected the file: {response.get('message', response.get('status'))}")
+            return False
+        return True
+
+    def report_missed(futures):
+        wait(futures)
+        report_missed_writes({filename: [server for future, server in futures.items() if not future.result()]},
+                             username, naming_server_host, naming_server_port)
+
+    write_quorum = len(replicas) // 2 + 1
+    acknowledged = 0
+    executor = ThreadPoolExecutor(max_workers=len(replicas) + 1)
+    try:
+        futures = {executor.submit(store, server): server for server in replicas}
+        executor.submit(report_missed, futures)
+        for future in as_completed(futures):
+            if future.result():
+                acknowledged += 1
+                if acknowledged >= write_quorum:
+                    print(Fore.GREEN +f"File stored successfully ({acknowledged}/{len(replicas)} replicas acknowledged)")
+                    return True
+    finally:
+        executor.shutdown(wait=False)
+    print(Fore.RED + f"File stored on only {acknowledged} of {len(replicas)} replicas; write quorum is {write_quorum}")
+    return False
+
+def get_file_from_storage_server(server_details, filename,username):
+    """
+    Stream a file from one storage server straight to disk and return its reply. A file the
+    server keeps compressed in a codec we accept arrives compressed and is decompressed here.
+    """
+    def get(conn):
+        started = time.monotonic()
+        response = conn.request({'op': 'GET', 'filename': filename, 'username': username, 'length': 0,
+                                 'accept': list(CODECS)})
+        record_latency(server_details, time.monotonic() - started)
+        if response.get('status') == 'OK':
+            decompressor = CODECS[response['codec']][1]() if 'codec' in response else None
+            length = response['length']
+            buffer = bytearray(min(CHUNK_SIZE, length))
+            view = memoryview(buffer)
+            remaining = length
+            # Download next to the target so a failed transfer never clobbers an existing copy
+            with open(f'{filename}.part', 'wb') as f:
+                while remaining > 0:
+                    count = conn.sock.recv_into(view, min(len(buffer), remaining))
+                    if count == 0:
+                        raise ConnectionError("Connection closed by storage server")
+                    f.write(view[:count] if decompressor is None else decompressor.decompress(view[:count]))
+                    remaining -= count
+            os.replace(f'{filename}.part', filename)
+        return response
+
+    return pool.run(parse_address(server_details), get)
+
+def fetch_file_from_replicas(servers, filename, username):
+    """ Download a file from the replica the naming server ranked first, failing over to the next one on any error. """
+    for server in rank_replicas(servers):
+        try:
+            response = get_file_from_storage_server(server, filename, username)
+        except Exception as e:
+            print(Fore.RED + f"Error retrieving file from storage server {server}: {e}")
+            record_failure(server)
+            continue
+        status = response.get('status')
+        if status == 'FILE_IS_EMPTY':
+            print(Fore.MAGENTA +"YOUR FILE DOES NOT HAVE CONTENT")
+            return True
+        if status == 'OK':
+            print(Fore.GREEN +f"File saved successfully! ({response.get('size', response['length'])} bytes)")
+            return True
+        print(Fore.MAGENTA + f"Storage server {server} could not provide the file: {response.get('message', status)}")
+    print(Fore.MAGENTA +"File could not be retrieved from any replica.")
+    return False
         
-def list_all_files(server_details,username):
-    server_ip, server_port = server_details.split(':')
+def stripe_name(filename, index):
+    """ The hidden name stripe number index of a striped file is stored under. """
+    return f'.{filename}.stripe{index}'
+
+def send_range_to_storage_server(server_details, filename, username, remote_name, offset, length):
+    """ Upload bytes [offset, offset + length) of a local file to one storage server as remote_name. """
+    def put(conn):
+        with open(filename, 'rb') as f:
+            request_id = conn.send({'op': 'PUT', 'filename': remote_name, 'username': username, 'length': length})
+            f.seek(offset)
+            send_from_file(conn.sock, f, length)
+        return conn.receive(request_id)
+
+    return pool.run(parse_address(server_details), put)
+
+def store_file_striped(servers, copies, filename, username, naming_server_host, naming_server_port):
+    """
+    Split a file into stripes dealt round-robin over the given servers, with each stripe also
+    copied to the next copies - 1 servers. All stripes are uploaded concurrently; once every
+    stripe has a majority of its copies stored, the layout is recorded with the naming server,
+    listing only the servers that stored each stripe.
+    """
+    size = os.path.getsize(filename)
+    count = max(1, -(-size // STRIPE_SIZE))
+    copies = max(1, min(copies, len(servers)))
+    stripes = [[servers[(index + copy) % len(servers)] for copy in range(copies)] for index in range(count)]
+
+    def store(index, server):
+        offset = index * STRIPE_SIZE
+        try:
+            response = send_range_to_storage_server(server, filename, username, stripe_name(filename, index),
+                                                    offset, min(STRIPE_SIZE, size - offset))
+        except Exception as e:
+            print(Fore.RED + f"Error sending stripe {index} to storage server {server}: {e}")
+            return False
+        if response.get('status') != 'PUT_COMPLETE':
+            print(Fore.RED + f"Storage server {server} rejected stripe {index}: {response.get('message', response.get('status'))}")
+            return False
+        return True
+
+    stored = set()  # (stripe, server) pairs stored
+    with ThreadPoolExecutor(max_workers=STRIPE_WORKERS) as executor:
+        futures = {executor.submit(store, index, server): (index, server)
+                   for index, stripe_servers in enumerate(stripes) for server in stripe_servers}
+        for future in as_completed(futures):
+            if future.result():
+                stored.add(futures[future])
+    # Servers that missed a stripe may hold an older version of it, so the layout leaves them out
+    stripes = [[server for server in stripe_servers if (index, server) in stored]
+               for index, stripe_servers in enumerate(stripes)]
+    write_quorum = copies // 2 + 1
+    if any(len(stripe_servers) < write_quorum for stripe_servers in stripes):
+        print(Fore.RED + "Some stripes could not be stored on enough servers; the upload failed.")
+        return False
+
+    layout = {'type': 'stripe', 'filename': filename, 'username': username,
+              'size': size, 'stripe_size': STRIPE_SIZE, 'stripes': stripes}
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((server_ip, int(server_port)))
-            message = f"LIST|||{username}"
-            
-            s.sendall(message.encode())
-            response = s.recv(1024).decode()
-            return response
+        response = pool.run((naming_server_host, naming_server_port), lambda conn: conn.request(layout))
+    except Exception as e:
+        print(Fore.RED + f"Failed to record the stripe layout with the naming server: {e}")
+        return False
+    if response.get('status') != 'layout recorded':
+        print(Fore.RED + f"Naming server rejected the stripe layout: {response.get('message')}")
+        return False
+    location_cache.observe(response)
+    print(Fore.GREEN +f"File stored successfully ({count} stripes over {len(servers)} servers)")
+    return True
+
+def fetch_file_striped(layout, filename, username):
+    """
+    Download a striped file by fetching its stripes concurrently and writing each one at its
+    offset in the local file. A stripe that fails part-way resumes from the next copy with a
+    byte-range GET, so nothing already received is fetched twice.
+    """
+    size = layout['size']
+    stripe_size = layout['stripe_size']
+    part_path = f'{filename}.part'
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+
+    def fetch(index):
+        offset = index * stripe_size
+        length = min(stripe_size, size - offset)
+        received = 0
+
+        def get(conn):
+            nonlocal received
+            response = conn.request({'op': 'GET', 'filename': stripe_name(filename, index), 'username': username,
+                                     'offset': received, 'count': length - received})
+            if response.get('status') != 'OK' or response['length'] != length - received:
+                raise IOError(f"stripe unavailable: {response.get('message', response.get('status'))}")
+            buffer = bytearray(min(CHUNK_SIZE, length - received))
+            view = memoryview(buffer)
+            with open(part_path, 'r+b') as f:
+                f.seek(offset + received)
+                while received < length:
+                    count = conn.sock.recv_into(view, min(len(buffer), length - received))
+                    if count == 0:
+                        raise ConnectionError("Connection closed by storage server")
+                    f.write(view[:count])
+                    received += count
+
+        for server in rank_replicas(layout['stripes'][index], ranked=False):
+            try:
+                pool.run(parse_address(server), get)
+                return True
+            except Exception as e:
+                print(Fore.RED + f"Error retrieving stripe {index} from storage server {server}: {e}")
+                record_failure(server)
+        return False
+
+    with ThreadPoolExecutor(max_workers=STRIPE_WORKERS) as executor:
+        results = list(executor.map(fetch, range(len(layout['stripes']))))
+    if not all(results):
+        os.remove(part_path)
+        print(Fore.MAGENTA +"Some stripes could not be retrieved from any server.")
+        return False
+    os.replace(part_path, filename)
+    print(Fore.GREEN +f"File saved successfully! ({size} bytes from {len(results)} stripes)")
+    return True
+
+def list_all_files(server_details, username, prefix='', details=False):
+    """
+    List a user's files on one storage server, page by page. With details set, return a
+    dict of filename -> {'size', 'mtime'} instead of a list of names.
+    """
+    files = {} if details else []
+    cursor = None
+    try:
+        while True:
+            request = {'op': 'LIST', 'filename': '', 'username': username, 'length': 0,
+                       'prefix': prefix, 'cursor': cursor, 'details': details}
+            response = pool.run(parse_address(server_details), lambda conn: conn.request(request))
+            if details:
+                files.update(response.get('details', {}))
+            else:
+                files.extend(response.get('files', []))
+            cursor = response.get('cursor')
+            if cursor is None:
+                return files
     except Exception as e:
         print(Fore.RED + f"Error  No files : {e}")
-        
-def create_connection():
+        return None
+
+def send_files_to_storage_server(server_details, paths, username):
+    """
+    Upload a batch of local files to one storage server in a single MPUT request, stored
+    under their base names, and return the server's reply.
+    """
+    def mput(conn):
+        files = [{'filename': os.path.basename(path), 'length': os.path.getsize(path)} for path in paths]
+        request_id = conn.send({'op': 'MPUT', 'username': username, 'files': files,
+                                'length': sum(entry['length'] for entry in files)})
+        for path, entry in zip(paths, files):
+            with open(path, 'rb') as f:
+                send_from_file(conn.sock, f, entry['length'])
+        return conn.receive(request_id)
+
+    return pool.run(parse_address(server_details), mput)
+
+def get_files_from_storage_server(server_details, filenames, username):
+    """ Download a batch of files from one storage server with a single MGET request and return its reply. """
+    def mget(conn):
+        response = conn.request({'op': 'MGET', 'username': username, 'files': filenames, 'length': 0})
+        for entry in response.get('files', []):
+            remaining = entry['length']
+            if entry['status'] not in ('OK', 'FILE_IS_EMPTY'):
+                continue
+            with open(f"{entry['filename']}.part", 'wb') as f:
+                while remaining > 0:
+                    data = conn.sock.recv(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise ConnectionError("Connection closed by storage server")
+                    f.write(data)
+                    remaining -= len(data)
+            os.replace(f"{entry['filename']}.part", entry['filename'])
+        return response
+
+    return pool.run(parse_address(server_details), mget)
+
+def sync_directory(directory, username, naming_server_host, naming_server_port):
+    """
+    Upload every file in a local directory. All files are located with one batch query,
+    then each storage server receives the files it replicates in MPUT batches, so a
+    whole directory costs a few round trips instead of several per file. A file counts
+    as synced once a majority of its replicas stored it; replicas that did not store it are
+    reported to the naming server.
+    """
+    paths = {name: os.path.join(directory, name) for name in sorted(os.listdir(directory))
+             if os.path.isfile(os.path.join(directory, name))}
+    if not paths:
+        print(Fore.MAGENTA +"No files to sync in that directory.")
+        return False
+    located = locate_files(list(paths), naming_server_host, naming_server_port, username)
+    batches = {}
+    for name, response in located.items():
+        for server in response.get('replicas', []):
+            batches.setdefault(server, []).append(name)
+
+    def store(server, names):
+        try:
+            response = send_files_to_storage_server(server, [paths[name] for name in names], username)
+        except Exception as e:
+            print(Fore.RED + f"Error sending files to storage server {server}: {e}")
+            return []
+        for name, message in response.get('failed', {}).items():
+            print(Fore.RED + f"Storage server {server} rejected {name}: {message}")
+        return response.get('stored', [])
+
+    acknowledged = dict.fromkeys(paths, 0)
+    stored_on = {}  # file -> servers that stored it
+    with ThreadPoolExecutor(max_workers=max(1, len(batches))) as executor:
+        futures = {executor.submit(store, server, names[start:start + BATCH_FILES]): server
+                   for server, names in batches.items() for start in range(0, len(names), BATCH_FILES)}
+        for future in as_completed(futures):
+            for name in future.result():
+                acknowledged[name] += 1
+                stored_on.setdefault(name, set()).add(futures[future])
+    report_missed_writes({name: [server for server in response.get('replicas', [])
+                                 if server not in stored_on.get(name, ())]
+                          for name, response in located.items()},
+                         username, naming_server_host, naming_server_port)
+    synced = [name for name in paths
+              if name in located and acknowledged[name] >= len(located[name].get('replicas', [])) // 2 + 1]
+    for name in paths:
+        location_cache.invalidate(name, username)
+    print((Fore.GREEN if len(synced) == len(paths) else Fore.MAGENTA) + f"Synced {len(synced)} of {len(paths)} files.")
+    return len(synced) == len(paths)
+
+def fetch_files(filenames, username, naming_server_host, naming_server_port):
+    """
+    Download several files, asking the replica the naming server ranked first for each file
+    for all of its files in MGET batches. Files a server could not provide are fetched one by one from the other replicas.
     """
-    Create and return a MySQL database connection.
+    located = locate_files(filenames, naming_server_host, naming_server_port, username)
+    batches = {}
+    for name in filenames:
+        servers = rank_replicas(located.get(name, {}).get('servers', []))
+        if servers and not located[name].get('layout'):
+            batches.setdefault(servers[0], []).append(name)
+    fetched = set()
+    for server, names in batches.items():
+        for start in range(0, len(names), BATCH_FILES):
+            try:
+                response = get_files_from_storage_server(server, names[start:start + BATCH_FILES], username)
+            except Exception as e:
+                print(Fore.RED + f"Error retrieving files from storage server {server}: {e}")
+                record_failure(server)
+                continue
+            fetched.update(entry['filename'] for entry in response.get('files', [])
+                           if entry['status'] in ('OK', 'FILE_IS_EMPTY'))
+    for name in filenames:
+        if name not in fetched and download(located.get(name), name, username):
+            fetched.add(name)
+    print((Fore.GREEN if len(fetched) == len(filenames) else Fore.MAGENTA) +
+          f"Downloaded {len(fetched)} of {len(filenames)} files.")
+    return len(fetched) == len(filenames)
 
+def create_connection():
+    """
+    Return a MySQL database connection from the pool. Closing it hands it back to the
+    pool instead of tearing it down, so registrations do not pay for a new connection each time.
     """
+    global db_pool
     try:
-        connection = mysql.connector.connect(
-            host='localhost',
-            user='root',  # Replace with your MySQL username
-            password='',  # Replace with your MySQL password
-            database='comp5504_users',  # Replace with your database name
-        )
-        
-            
-        return connection
+        if db_pool is None:
+            db_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='dfs_auth', pool_size=DB_POOL_SIZE,
+                                                                  **DB_CONFIG)
+        return db_pool.get_connection()
     except Error as e:
         print(Fore.RED + f"Error connecting to MySQL: {e}")
         return None
@@ -113,35 +934,47 @@ def register_user():
             cursor.close()
             connection.close()
 
-def login_user(username):
+def session_expired():
+    return session_token is not None and int(session_token.rsplit(':', 2)[1]) <= time.time()
+
+def login_user(username, naming_server_host, naming_server_port):
     """
-    Authenticate a user by comparing the entered password (after hashing) with the stored hashed password.
+    Log in through the naming server, which checks the password against the users database and
+    returns a session token for the storage servers, signed with a secret this client does not hold.
     """
-    
+    global session_token
     password = getpass.getpass("Enter password: ")  # Securely read password
-    hashed_password = hashlib.sha256(password.encode()).hexdigest()  # Hash the password
+    request = {'type': 'login', 'username': username, 'password': password}
+    try:
+        response = pool.run((naming_server_host, naming_server_port), lambda conn: conn.request(request))
+    except Exception as e:
+        print(Fore.RED + f"Failed to contact the naming server: {e}")
+        return False
+    if response.get('status') != 'logged in':
+        print(Fore.RED + response.get('message', 'Login failed'))
+        return False
+    print(Fore.GREEN +"Login successful!")
+    session_token = response.get('token')
+    return True
 
-    connection = create_connection()
-    if connection:
-        cursor = connection.cursor()
-        query = "SELECT password FROM users WHERE username = %s"
-        try:
-            cursor.execute(query, (username,))
-            record = cursor.fetchone()
-            if record:
-                stored_password = record[0]
-                if hashed_password == stored_password:
-                    print(Fore.GREEN +"Login successful!")
-                    return True
-                else:
-                    print(Fore.RED +"Password is incorrect")
-            else:
-                print(Fore.MAGENTA +"Username not found")
-        except Error as e:
-            print(Fore.RED + f"Failed to query database: {e}")
-        finally:
-            cursor.close()
-            connection.close()
+def upload(server_info, filename, username, naming_server_host, naming_server_port):
+    """ Store a file where a query reply says to: striped if it lists stripe servers, else on its replicas. """
+    if server_info and len(server_info.get('stripe_servers', [])) > 1:
+        return store_file_striped(server_info['stripe_servers'], len(server_info['replicas']), filename, username,
+                                  naming_server_host, naming_server_port)
+    if server_info and server_info.get('replicas'):
+        return store_file_on_replicas(server_info['replicas'], filename, username,
+                                      naming_server_host, naming_server_port)
+    print(Fore.MAGENTA +"No available storage server found.")
+    return False
+
+def download(server_info, filename, username):
+    """ Fetch a file from where a query reply says it lives. """
+    if server_info and server_info.get('layout'):
+        return fetch_file_striped(server_info['layout'], filename, username)
+    if server_info and 'servers' in server_info and server_info['servers']:
+        return fetch_file_from_replicas(server_info['servers'], filename, username)
+    print(Fore.MAGENTA +"File not found on any server.")
     return False
 
 def LoginSuccess(naming_server_host, naming_server_port,username):
@@ -150,52 +983,74 @@ def LoginSuccess(naming_server_host, naming_server_port,username):
         print(Fore.CYAN + Style.BRIGHT + "1." + Fore.GREEN + " Upload a File.")
         print(Fore.CYAN + Style.BRIGHT + "2." + Fore.GREEN + " Download a File")
         print(Fore.CYAN + Style.BRIGHT + "3." + Fore.GREEN + " List All Files.")
-        print(Fore.CYAN + Style.BRIGHT + "4." + Fore.RED + " Exit.")
+        print(Fore.CYAN + Style.BRIGHT + "4." + Fore.GREEN + " Sync a Directory.")
+        print(Fore.CYAN + Style.BRIGHT + "5." + Fore.GREEN + " Download Several Files.")
+        print(Fore.CYAN + Style.BRIGHT + "6." + Fore.RED + " Exit.")
 
-        operation = input("Enter Operation (1-4): ")
-        if operation == '4':
+        operation = input("Enter Operation (1-6): ")
+        if session_expired():
+            print(Fore.RED + "Your session has expired. Please log in again.")
+            break
+        if operation == '6':
             print(Fore.RED + "Exiting...")
             break
 
         elif operation == '3':
-            server_info = contact_naming_server_for_info("",naming_server_host, naming_server_port)
-            response = list_all_files(server_info['servers'][0],username)
-            files = json.loads(response)
-            if files == []:
+            server_info = locate_file("", naming_server_host, naming_server_port)[0]
+            if not server_info or not server_info.get('servers'):
+                print(Fore.MAGENTA +"No available storage server found.")
+                continue
+            prefix = input("Only list files starting with (leave empty for all): ")
+            # Files are spread over every storage server, so gather the listing from all of them
+            files = {}
+            for server in server_info['servers']:
+                files.update(list_all_files(server, username, prefix, details=True) or {})
+            if not files:
                 print(Fore.MAGENTA +"NO FILES TO LIST")
             else:    
                 print(Fore.GREEN +"Available Files:")
-                for file in files:
-                    print(file)
+                for file in sorted(files):
+                    size = files[file] and files[file]['size']
+                    print(file if size is None else f"{file}  ({size} bytes)")
                 
         
         elif operation == '1':
             filename = input("Enter filename: ")
-            try:
-                with open(filename, 'r') as file:
-                    content = file.read()
-                    print(content)
-                    file.close()
-            except:
+            if not os.path.isfile(filename):
                 print(Fore.MAGENTA +"File not found. Please make sure the file exists in the current directory.")
+                continue
 
-            server_info = contact_naming_server_for_info(filename, naming_server_host, naming_server_port)
-            if server_info and 'servers' in server_info and server_info['servers']:
-                send_file_to_storage_server(server_info['servers'][0], filename, content,username)
-            else:
-                print(Fore.MAGENTA +"No available storage server found.")
+            striped = os.path.getsize(filename) >= STRIPE_THRESHOLD
+            server_info, cached = locate_file(filename, naming_server_host, naming_server_port, username, striped)
+            stored = upload(server_info, filename, username, naming_server_host, naming_server_port)
+            if not stored and cached:
+                # The cached locations may be stale: ask the naming server and try once more
+                server_info = contact_naming_server_for_info(filename, naming_server_host, naming_server_port, username, striped)
+                upload(server_info, filename, username, naming_server_host, naming_server_port)
+            # The upload changed where the file lives
+            location_cache.invalidate(filename, username)
 
         elif operation == '2':
             filename = input("Enter filename: ")
-            server_info = contact_naming_server_for_info(filename, naming_server_host, naming_server_port)
-            if server_info and 'servers' in server_info and server_info['servers']:
-              
-                get_file_from_storage_server(server_info['servers'][0], filename,username)
-            else:
-                print(Fore.MAGENTA +"File not found on any server.")
+            server_info, cached = locate_file(filename, naming_server_host, naming_server_port, username)
+            if not download(server_info, filename, username) and cached:
+                server_info = contact_naming_server_for_info(filename, naming_server_host, naming_server_port, username)
+                download(server_info, filename, username)
+
+        elif operation == '4':
+            directory = input("Enter directory: ")
+            if not os.path.isdir(directory):
+                print(Fore.MAGENTA +"Directory not found.")
+                continue
+            sync_directory(directory, username, naming_server_host, naming_server_port)
+
+        elif operation == '5':
+            filenames = [name.strip() for name in input("Enter filenames separated by commas: ").split(',') if name.strip()]
+            if filenames:
+                fetch_files(filenames, username, naming_server_host, naming_server_port)
 
         else:
-            print(Fore.MAGENTA +"Invalid choice. Please select 1, 2, 3 or 4.")
+            print(Fore.MAGENTA +"Invalid choice. Please select 1 to 6.")
                 
 
 def main():
@@ -213,12 +1068,14 @@ def main():
             register_user()
             
         elif choice == '2':
+            naming_server_host = input("Enter server host: ")
+            naming_server_port = int(input("Ente server port: "))
             username = input("Enter username: ")
-            if login_user(username):
+            if login_user(username, naming_server_host, naming_server_port):
                 print(Fore.CYAN + "Welcome to the DFS!")
-                naming_server_host = input("Enter server host: ")
-                naming_server_port = int(input("Ente server port: "))
                 LoginSuccess(naming_server_host, naming_server_port,username)
+                # Logged out: keep no connections open for the next user
+                pool.close_all()
             else:
                 print(Fore.RED +"Failed to log in. Please try again.")
         elif choice == '3':
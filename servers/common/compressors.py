@@ -0,0 +1,62 @@
+"""
+Compression codecs for uploads and stored files, shared by the client and the storage server.
+
+A client may send a PUT body compressed with any codec the server lists in reply to CODECS, naming it in the
+request's 'codec' field along with the original 'size'. The file store keeps such a body exactly as received,
+behind a small header recording the codec and size, so a GET from a client that accepts the codec sends the
+stored bytes without recompressing them, and other clients get them decompressed.
+
+Codecs are (compressor factory, decompressor factory) pairs with the zlib/lzma streaming interface:
+compressor.compress(data) / compressor.flush() and decompressor.decompress(data), most preferred first. More
+can be added with register_codec, which both the client and the storage server then offer.
+"""
+
+
+import json
+import lzma
+import struct
+import zlib
+
+MAGIC = b'\x89DFSBLOB'  # start of a stored file that carries a codec header
+HEADER_LENGTH = struct.Struct('!I')  # 4-byte big-endian length of the JSON codec header
+CHUNK_SIZE = 64 * 1024  # bytes decompressed per step
+
+CODECS = {
+    'zlib': (zlib.compressobj, zlib.decompressobj),
+    'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+
+def register_codec(name, compressor, decompressor):
+    CODECS[name] = (compressor, decompressor)
+
+def blob_header(codec, size=None):
+    """
+    The header written in front of a stored file. Plain files only get one (with codec
+    'identity') when their contents happen to start with MAGIC.
+    """
+    payload = json.dumps({'codec': codec, 'size': size}).encode()
+    return MAGIC + HEADER_LENGTH.pack(len(payload)) + payload
+
+def read_blob_header(f):
+    """
+    Read the codec header of a stored file opened at its start. Return (codec, original size,
+    offset of the data), with codec and size None for files stored as they are.
+    """
+    prefix = f.read(len(MAGIC) + HEADER_LENGTH.size)
+    if len(prefix) < len(MAGIC) + HEADER_LENGTH.size or not prefix.startswith(MAGIC):
+        return None, None, 0
+    (length,) = HEADER_LENGTH.unpack(prefix[len(MAGIC):])
+    header = json.loads(f.read(length).decode())
+    if header['codec'] == 'identity':
+        return None, None, len(prefix) + length
+    return header['codec'], header['size'], len(prefix) + length
+
+def decompress_file(source, codec, target):
+    """ Decompress the rest of an open file into another. """
+    decompressor = CODECS[codec][1]()
+    while True:
+        data = source.read(CHUNK_SIZE)
+        if not data:
+            break
+        target.write(decompressor.decompress(data))
+    target.flush()
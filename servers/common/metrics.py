@@ -0,0 +1,289 @@
+"""
+Low-overhead request metrics and an on-demand sampling profiler.
+
+Every request is timed by a RequestTimer. The handler marks the phases it goes through (for example recv, disk,
+send) with `with timer.phase(name)`. Time is charged to the innermost phase only, so nested phases never count
+twice. When the request finishes, its total latency, the time spent in each phase and its bytes in and out are
+added to per-operation counters and fixed-bucket histograms under one short lock.
+
+Metrics.snapshot() returns the figures as JSON (with p50/p99 estimated from the buckets). Metrics.render()
+returns them in the Prometheus text exposition format, which serve_metrics can also publish over HTTP.
+
+SamplingProfiler records the stacks of every thread at a fixed interval while it is running. It can be switched
+on and off at runtime. Its report lists folded stacks ('file:function;file:function count'), ready for
+flamegraph tools.
+
+Both the naming server and the storage server import this module from servers/common, so deploy that directory
+alongside either of them.
+"""
+
+
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # histogram upper bounds in seconds
+PROFILE_INTERVAL = 0.01  # seconds between profiler samples
+PROFILE_LIMIT = 200  # most frequent stacks returned by a profile report
+
+class Histogram:
+    """ Counts of observations per bucket, plus their sum. """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, fraction):
+        """ Upper bound of the bucket holding the given quantile, in milliseconds (None past the last bound). """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound * 1000
+        return None
+
+class Operation:
+    """ Everything recorded about one kind of request. """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.phases = {}
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+class RequestTimer:
+    """ Times one request and the phases it passes through. """
+
+    def __init__(self, metrics, op):
+        self.metrics = metrics
+        self.op = op
+        self.started = self.mark = time.perf_counter()
+        self.current = None
+        self.phases = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.failed = False
+
+    def switch(self, phase):
+        """ Charge the time since the last switch to the current phase and move on to another. """
+        now = time.perf_counter()
+        if self.current is not None:
+            self.phases[self.current] = self.phases.get(self.current, 0.0) + now - self.mark
+        self.current = phase
+        self.mark = now
+
+    @contextmanager
+    def phase(self, name):
+        previous = self.current
+        self.switch(name)
+        try:
+            yield
+        finally:
+            self.switch(previous)
+
+    def finish(self):
+        self.switch(None)
+        self.metrics.record(self, time.perf_counter() - self.started)
+
+class Metrics:
+    """ Per-operation counters and histograms for one server, named '<prefix>_...' when exported. """
+
+    def __init__(self, prefix, gauges=None):
+        self.prefix = prefix
+        self.gauges = gauges  # function returning {name: value} of current levels, read when exporting
+        self.operations = {}
+        self.accept = Histogram()
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def start(self, op):
+        return RequestTimer(self, op)
+
+    def record(self, timer, seconds):
+        with self.lock:
+            operation = self.operations.get(timer.op)
+            if operation is None:
+                operation = self.operations[timer.op] = Operation()
+            operation.latency.observe(seconds)
+            for phase, phase_seconds in timer.phases.items():
+                histogram = operation.phases.get(phase)
+                if histogram is None:
+                    histogram = operation.phases[phase] = Histogram()
+                histogram.observe(phase_seconds)
+            operation.errors += timer.failed
+            operation.bytes_in += timer.bytes_in
+            operation.bytes_out += timer.bytes_out
+
+    def record_accept(self, seconds):
+        """ Time a new connection waited between being accepted and being served. """
+        with self.lock:
+            self.accept.observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            operations = {op: {
+                'count': operation.latency.count,
+                'errors': operation.errors,
+                'bytes_in': operation.bytes_in,
+                'bytes_out': operation.bytes_out,
+                'seconds': round(operation.latency.total, 6),
+                'latency_ms': {'p50': operation.latency.quantile(0.5), 'p99': operation.latency.quantile(0.99)},
+                'phase_seconds': {phase: round(histogram.total, 6) for phase, histogram in operation.phases.items()},
+            } for op, operation in self.operations.items()}
+            accept = {'count': self.accept.count, 'seconds': round(self.accept.total, 6),
+                      'latency_ms': {'p50': self.accept.quantile(0.5), 'p99': self.accept.quantile(0.99)}}
+        return {'uptime': round(time.time() - self.started, 3), 'operations': operations, 'accept': accept,
+                'gauges': self.gauges() if self.gauges else {}}
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format. """
+        prefix = self.prefix
+        lines = []
+        with self.lock:
+            lines.append(f'# TYPE {prefix}_requests_total counter')
+            lines += [f'{prefix}_requests_total{{op="{op}"}} {operation.latency.count}' for op, operation in self.operations.items()]
+            lines.append(f'# TYPE {prefix}_errors_total counter')
+            lines += [f'{prefix}_errors_total{{op="{op}"}} {operation.errors}' for op, operation in self.operations.items()]
+            lines.append(f'# TYPE {prefix}_bytes_total counter')
+            for op, operation in self.operations.items():
+                lines.append(f'{prefix}_bytes_total{{op="{op}",direction="in"}} {operation.bytes_in}')
+                lines.append(f'{prefix}_bytes_total{{op="{op}",direction="out"}} {operation.bytes_out}')
+            lines.append(f'# TYPE {prefix}_request_seconds histogram')
+            for op, operation in self.operations.items():
+                lines += histogram_lines(f'{prefix}_request_seconds', f'op="{op}"', operation.latency)
+            lines.append(f'# TYPE {prefix}_phase_seconds histogram')
+            for op, operation in self.operations.items():
+                for phase, histogram in operation.phases.items():
+                    lines += histogram_lines(f'{prefix}_phase_seconds', f'op="{op}",phase="{phase}"', histogram)
+            lines.append(f'# TYPE {prefix}_accept_seconds histogram')
+            lines += histogram_lines(f'{prefix}_accept_seconds', '', self.accept)
+        for name, value in (self.gauges() if self.gauges else {}).items():
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+def histogram_lines(name, labels, histogram):
+    separator = ',' if labels else ''
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+    plain = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{plain} {histogram.total}')
+    lines.append(f'{name}_count{plain} {histogram.count}')
+    return lines
+
+def serve_metrics(host, port, metrics):
+    """ Publish the metrics at http://host:port/metrics from a background thread. """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread at a fixed interval while running. Sampling is by wall clock,
+    so threads blocked on sockets or disks show up as well as busy ones.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = PROFILE_INTERVAL
+        self.started = None
+
+    def start(self, interval=PROFILE_INTERVAL):
+        """ Start sampling, discarding the previous profile. Returns False if already running. """
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.interval = max(interval, 0.001)
+            self.started = time.monotonic()
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stop_event,), daemon=True, name='profiler')
+            self.thread.start()
+            return True
+
+    def stop(self, limit=PROFILE_LIMIT):
+        """ Stop sampling and return the profile. """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            stop_event = self.stop_event
+        if thread is not None:
+            stop_event.set()
+            thread.join()
+        return self.report(limit)
+
+    def running(self):
+        return self.thread is not None
+
+    def run(self, stop_event):
+        own = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            stacks = [folded_stack(frame) for thread_id, frame in sys._current_frames().items() if thread_id != own]
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def report(self, limit=PROFILE_LIMIT):
+        with self.lock:
+            return {'running': self.thread is not None, 'samples': self.samples, 'interval': self.interval,
+                    'seconds': round(time.monotonic() - self.started, 3) if self.started else 0,
+                    'stacks': [f'{stack} {count}' for stack, count in self.stacks.most_common(limit)]}
+
+def folded_stack(frame):
+    """ 'file:function;file:function' from the outermost call to the innermost. """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def handle_profile(profiler, request):
+    """ Start or stop the profiler ('action' start, stop or status) and describe its state. """
+    action = request.get('action', 'status')
+    if action == 'start':
+        started = profiler.start(request.get('interval', PROFILE_INTERVAL))
+        return {'running': True, 'started': started}
+    if action == 'stop':
+        return profiler.stop(request.get('limit', PROFILE_LIMIT))
+    return profiler.report(request.get('limit', PROFILE_LIMIT))
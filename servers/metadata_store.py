@@ -0,0 +1,163 @@
+"""
+Crash-recoverable metadata for the naming server.
+
+The naming server's state (registered storage servers, the index of which servers hold which file, and
+the layouts of striped files) lives in a MetadataStore. Every change is first appended as one JSON line to a
+write-ahead log and then applied in memory; every so often the whole state is written to a snapshot and the
+log is truncated. On startup the snapshot is loaded and the log replayed on top of it, so a restarted naming
+server answers queries straight away instead of waiting for every storage server to register again.
+
+Log entries are idempotent: replaying an entry that is already reflected in the snapshot (after a crash
+between writing a snapshot and truncating the log) leaves the state unchanged.
+
+All reads and writes of the state happen under the store's lock.
+"""
+
+
+import json
+import os
+import threading
+import time
+
+SNAPSHOT_EVERY = 10000  # log entries between snapshots
+
+class MetadataStore:
+    """ Registered storage servers, the file location index and stripe layouts, persisted as snapshot + log. """
+
+    def __init__(self, snapshot_every=SNAPSHOT_EVERY, sync=False):
+        self.lock = threading.RLock()
+        self.servers = {}  # server id -> {'status', 'files' (set of file keys), 'last_heartbeat', 'stats', ...}
+        self.file_locations = {}  # file key -> set of server ids holding it
+        self.file_layouts = {}  # file key -> stripe layout
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.directory = None
+        self.log = None
+        self.logged = 0
+
+    def open(self, directory):
+        """ Recover the state saved in directory, then log every later change there. """
+        with self.lock:
+            os.makedirs(directory, exist_ok=True)
+            self.directory = directory
+            started = time.monotonic()
+            if os.path.exists(self.snapshot_path()):
+                with open(self.snapshot_path(), 'r') as f:
+                    self.load_snapshot(json.load(f))
+            replayed = 0
+            valid_length = 0
+            if os.path.exists(self.log_path()):
+                with open(self.log_path(), 'rb') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break  # a torn write at the tail of the log
+                        if not line.endswith(b'\n'):
+                            break
+                        self.apply(entry)
+                        replayed += 1
+                        valid_length += len(line)
+            self.log = open(self.log_path(), 'a')
+            # Cut off a torn tail so later entries are not appended after it
+            self.log.truncate(valid_length)
+            self.logged = replayed
+            print(f"Recovered {len(self.servers)} servers and {len(self.file_locations)} files "
+                  f"({replayed} log entries) in {(time.monotonic() - started) * 1000:.1f} ms")
+
+    def snapshot_path(self):
+        return f'{self.directory}/snapshot.json'
+
+    def log_path(self):
+        return f'{self.directory}/wal.log'
+
+    def commit(self, entry):
+        """ Durably log a change, then apply it. """
+        with self.lock:
+            if self.log is not None:
+                self.log.write(json.dumps(entry) + '\n')
+                self.log.flush()
+                if self.sync:
+                    os.fsync(self.log.fileno())
+                self.logged += 1
+            self.apply(entry)
+            if self.log is not None and self.logged >= self.snapshot_every:
+                self.write_snapshot()
+
+    def apply(self, entry):
+        op = entry['op']
+        if op == 'register':
+            previous = self.servers.get(entry['server'])
+            if previous is not None:
+                for key in previous['files']:
+                    self.forget_location(key, entry['server'])
+            self.servers[entry['server']] = {'status': 'alive', 'files': set(), 'last_heartbeat': time.time(), 'stats': {}}
+            for key in entry['files']:
+                self.add_location(entry['server'], key)
+        elif op == 'store':
+            if entry['server'] in self.servers:
+                self.add_location(entry['server'], entry['key'])
+            # A whole copy replaces any earlier striped version of the file
+            self.file_layouts.pop(entry['key'], None)
+        elif op == 'drop':
+            if entry['server'] in self.servers:
+                self.servers[entry['server']]['files'].discard(entry['key'])
+            self.forget_location(entry['key'], entry['server'])
+        elif op == 'layout':
+            # Whole copies stored before are superseded by the striped version
+            for server in self.file_locations.pop(entry['key'], ()):
+                if server in self.servers:
+                    self.servers[server]['files'].discard(entry['key'])
+            self.file_layouts[entry['key']] = entry['layout']
+
+    def add_location(self, server_id, key):
+        self.servers[server_id]['files'].add(key)
+        self.file_locations.setdefault(key, set()).add(server_id)
+
+    def forget_location(self, key, server_id):
+        holders = self.file_locations.get(key)
+        if holders is not None:
+            holders.discard(server_id)
+            if not holders:
+                del self.file_locations[key]
+
+    def register_server(self, server_id, files):
+        self.commit({'op': 'register', 'server': server_id, 'files': list(files)})
+
+    def record_file(self, server_id, key):
+        self.commit({'op': 'store', 'server': server_id, 'key': key})
+
+    def drop_file(self, server_id, key):
+        """ A server no longer holds a file. """
+        self.commit({'op': 'drop', 'server': server_id, 'key': key})
+
+    def record_layout(self, key, layout):
+        self.commit({'op': 'layout', 'key': key, 'layout': layout})
+
+    def load_snapshot(self, snapshot):
+        """ Rebuild the state from a snapshot, into an empty store: each file key is indexed once, in constant time. """
+        now = time.time()
+        for server_id, files in snapshot['servers'].items():
+            self.servers[server_id] = {'status': 'alive', 'files': set(files), 'last_heartbeat': now, 'stats': {}}
+            for key in files:
+                holders = self.file_locations.get(key)
+                if holders is None:
+                    self.file_locations[key] = {server_id}
+                else:
+                    holders.add(server_id)
+        self.file_layouts.update(snapshot['file_layouts'])
+
+    def write_snapshot(self):
+        """ Save the whole state and start a fresh log. """
+        with self.lock:
+            snapshot = {'servers': {server_id: list(data['files']) for server_id, data in self.servers.items()},
+                        'file_layouts': self.file_layouts}
+            temp_path = f'{self.snapshot_path()}.part'
+            with open(temp_path, 'w') as f:
+                json.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path())
+            self.log.close()
+            self.log = open(self.log_path(), 'w')
+            self.logged = 0
@@ -0,0 +1,68 @@
+"""
+File placement for the naming server.
+
+Files are placed on storage servers with a consistent-hash ring. Every storage server owns many
+points ("virtual nodes") on the ring, and a file belongs to the first server found walking clockwise
+from the hash of its key. Adding or removing one of N servers therefore only moves about 1/N of the
+keys, and virtual nodes keep the share of each server close to even.
+"""
+
+
+import bisect
+import hashlib
+import threading
+
+VIRTUAL_NODES = 128  # ring points per storage server
+
+def ring_hash(value):
+    """ Map a string to a point on the ring. """
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+def file_key(username, filename):
+    """ The key a user's file is placed by. """
+    return f"{username}/{filename}"
+
+class HashRing:
+    """ A thread-safe consistent-hash ring of storage server ids. """
+
+    def __init__(self, virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.points = []  # sorted ring positions
+        self.owners = {}  # ring position -> server id
+        self.nodes = set()
+        self.lock = threading.Lock()
+
+    def add(self, node):
+        with self.lock:
+            if node in self.nodes:
+                return
+            self.nodes.add(node)
+            for replica in range(self.virtual_nodes):
+                point = ring_hash(f"{node}#{replica}")
+                if point not in self.owners:
+                    bisect.insort(self.points, point)
+                    self.owners[point] = node
+
+    def remove(self, node):
+        with self.lock:
+            if node not in self.nodes:
+                return
+            self.nodes.discard(node)
+            self.points = [point for point in self.points if self.owners[point] != node]
+            self.owners = {point: owner for point, owner in self.owners.items() if owner != node}
+
+    def nodes_for(self, key, count=1):
+        """ Return up to count distinct servers for key, in clockwise order starting at its owner. """
+        with self.lock:
+            if not self.points:
+                return []
+            count = min(count, len(self.nodes))
+            found = []
+            start = bisect.bisect(self.points, ring_hash(key))
+            for offset in range(len(self.points)):
+                owner = self.owners[self.points[(start + offset) % len(self.points)]]
+                if owner not in found:
+                    found.append(owner)
+                    if len(found) == count:
+                        break
+            return found
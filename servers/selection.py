@@ -0,0 +1,50 @@
+"""
+Load-aware server selection for the naming server.
+
+Storage servers report their load with every heartbeat. A selection policy orders a set of candidate servers
+using those reports, so the server clients try first is the one expected to answer soonest:
+- 'p2c' (power of two choices) repeatedly samples two of the remaining servers and takes the less loaded one.
+  It steers clear of busy servers without sending everyone to the same idle one while reports are stale.
+- 'least-connections' sorts by requests in flight plus connections queued.
+- 'capacity' shuffles with weights proportional to free disk, spreading load in proportion to capacity.
+Add a function taking (servers, load) and returning the servers in order to POLICIES to plug in another.
+"""
+
+
+import random
+
+def busy_connections(stats):
+    """ Requests a server is working on or has queued; servers that predate these figures report connections. """
+    return stats.get('in_flight', stats.get('active_connections', 0)) + stats.get('queue_depth', 0)
+
+def load_score(stats):
+    """ Roughly how long a new request would wait: the work ahead of it times the server's recent latency. """
+    return (busy_connections(stats) + 1) * max(stats.get('latency_ms', 0), 1.0)
+
+def power_of_two_choices(servers, load):
+    remaining = list(servers)
+    ranked = []
+    while len(remaining) > 1:
+        first, second = random.sample(range(len(remaining)), 2)
+        if load_score(load[remaining[second]]) < load_score(load[remaining[first]]):
+            first = second
+        ranked.append(remaining.pop(first))
+    return ranked + remaining
+
+def least_connections(servers, load):
+    return sorted(servers, key=lambda server: (busy_connections(load[server]), load_score(load[server])))
+
+def weighted_by_capacity(servers, load):
+    # Weighted shuffle: every server draws an exponential waiting time with rate equal to its free disk,
+    # so a server with twice the room is twice as likely to come first
+    return sorted(servers, key=lambda server: random.expovariate(max(load[server].get('free_disk', 1), 1)))
+
+POLICIES = {
+    'p2c': power_of_two_choices,
+    'least-connections': least_connections,
+    'capacity': weighted_by_capacity,
+}
+
+def has_room(stats, min_free_disk):
+    """ Whether a server may take new files; servers that have not reported their disk yet are given the benefit of the doubt. """
+    return stats.get('free_disk', min_free_disk) >= min_free_disk
@@ -3,113 +3,810 @@ This server code implements a naming server for a distributed file system. It ha
 
 Features include:
 - **Registration**: Storage servers can register themselves with their IP address and a unique port. This registration helps in tracking which servers are active and their last known state.
-- **Heartbeat Monitoring**: Registered servers must send heartbeats periodically. This mechanism helps the naming server keep track of which servers are still active. If a server fails to send a heartbeat within a designated timeout, it's marked as down.
-- **Query Handling**: Clients and servers can query the naming server to get a list of servers that are currently marked as 'alive'. This is useful for determining where to route client requests or data storage.
-- **Updates on Server Files**: Servers inform the naming server about changes to their stored files, enabling the naming server to maintain an up-to-date index of file locations.
+- **Heartbeat Monitoring**: Registered servers must push heartbeats periodically over their persistent connection, each carrying the server's load (free disk, requests in flight, queued connections, recent latency, bytes/s). If a server fails to send a heartbeat within a configurable timeout (`--heartbeat-timeout`, which may be below a second), it's marked as down. Deadlines are kept in a min-heap, so detecting failures costs time only for servers that actually expired. Queries return the reported load alongside the servers, ranked by a pluggable selection policy (`--selection`: power-of-two-choices by default, least-connections, or weighted by free disk), and new files are not placed on servers that are nearly full (`--min-free-disk`).
+- **Query Handling**: Clients and servers can query the naming server to get a list of servers that are currently marked as 'alive'. A query naming a file returns the servers holding it, or, for a new file, its owner on a consistent-hash ring of alive servers keyed by user and filename, so files spread over all storage servers and adding a server only moves a small share of new placements. Each file is replicated to several servers (`--replicas`, default 3); queries also return that replica set so clients can write to all of them and read from any.
+- **Updates on Server Files**: Servers report the files they hold when they register and every file they store afterwards, enabling the naming server to maintain an up-to-date index of file locations. Copies that missed a later write, on a server that was down or restarted meanwhile or on a replica a client's write did not reach, are taken out of the index and repaired by the rebalancer.
+- **Client Caching**: Query replies carry a lease and the current placement epoch. Clients cache replies until the lease runs out, and drop everything cached under an older epoch as soon as any reply shows that servers joined, failed or came back, or that a file was striped (`--lease`).
+- **Persistent Metadata**: Registrations, the file location index and stripe layouts are kept in a metadata store that appends every change to a write-ahead log and periodically snapshots the whole state (`--metadata-dir`). A restarted naming server reloads them in time linear in the number of files (about 0.2 s for 100,000 files held by three servers) and serves correct queries without waiting for storage servers to register again. All state is read and changed under the store's lock.
+- **Stripe Layouts**: Clients that split a large file into stripes spread over several servers record which servers hold each stripe, and later queries for the file return that layout so the stripes can be read in parallel. Recording a layout has the whole copies stored before deleted, and storing a whole copy again has the old stripes deleted, so a server that comes back with an older version never serves it.
+- **Rebalancing**: When a storage server joins, fails or comes back, a background rebalancer waits for membership to settle (`--rebalance-delay`) and then asks storage servers to copy files among themselves: files that lost replicas are copied to new ones, files whose ring owners changed are moved to them so new servers take their share, and surplus copies are deleted. Copies run a few at a time (`--rebalance-jobs`) within a total bandwidth limit (`--rebalance-bandwidth`), so clients keep most of the bandwidth. Stripes that lost copies are copied to new servers and their file's layout is updated to list them; otherwise stripes stay where the layout says.
+- **Login**: A 'login' request checks a user's password against the users database (MySQL through a connection pool, or a SQLite file with `--users-db`) and returns a session token signed with `--auth-secret`. Only the naming server and the storage servers hold that secret, so a client can act only as the user it logged in as.
+- **Metrics**: Every request is counted and timed per type (processing and sending), along with its bytes in and out and how long new connections waited to be served. A 'stats' request returns the figures (as JSON, or Prometheus text with 'format': 'prometheus'), `--metrics-port` serves them over HTTP at /metrics, and a 'profile' request starts and stops a sampling profiler at runtime.
 
-Each client and server connection is handled in its own thread, allowing the server to manage multiple simultaneous connections. The server uses JSON for communication, which simplifies data parsing and handling across different platforms.
+By default each client and server connection is handled in its own thread, allowing the server to manage multiple simultaneous connections. The server uses JSON for communication, which simplifies data parsing and handling across different platforms. Every message is preceded by a 4-byte length so that peers can keep one connection open, send many requests over it, and match each response to its request by the echoed 'id'.
 
 Usage:
 To start the server, you need to provide the host and port as command-line arguments. For example:
     python server.py 127.0.0.1 9999
 This command starts the server listening on localhost at port 9999.
+Add `--mode async` to serve every connection from one asyncio event loop instead, which scales to many thousands of
+concurrent connections; `--max-connections` bounds how many are served at once. The loop only moves messages: requests
+are processed on a small thread pool, so a metadata log write or a rebalancing plan never stalls other connections.
 """
 
 
+import argparse
+import asyncio
+import hashlib
+import heapq
+import hmac
+import os
 import socket
+import sqlite3
 import threading
 import json
+import struct
+import sys
 import time
-import sys  # Needed to access command-line arguments
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import mysql.connector.pooling
+except ImportError:  # only needed to check logins against MySQL
+    mysql = None
 
+# Modules shared with the storage server and the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common'))
+
+from auth import issue_token
+from metadata_store import MetadataStore
+from metrics import Metrics, SamplingProfiler, handle_profile, serve_metrics
+from placement import HashRing, file_key
+from selection import POLICIES, has_room
+
+MAX_CONNECTIONS = 16384  # connections served at once in async mode
+REQUEST_WORKERS = 16  # threads processing requests in async mode, off the event loop
+REPLICATION_FACTOR = 3  # copies kept of every file; overridden with --replicas
+METADATA_DIRECTORY = 'naming_metadata'  # where the metadata log and snapshots are kept
+HEARTBEAT_TIMEOUT = 15.0  # seconds without a heartbeat before a server is marked down; overridden with --heartbeat-timeout
+LEASE_DURATION = 10.0  # seconds clients may reuse a query result; overridden with --lease
+SELECTION_POLICY = 'p2c'  # how queried servers are ranked (see selection.py); overridden with --selection
+MIN_FREE_DISK = 1024 ** 3  # servers with less free disk get no new files; overridden with --min-free-disk
+REBALANCE_JOBS = 4  # copies between storage servers run at once; 0 disables rebalancing; overridden with --rebalance-jobs
+REBALANCE_BANDWIDTH = 32 * 1024 ** 2  # bytes/s shared by all running copies; overridden with --rebalance-bandwidth
+REBALANCE_DELAY = 10.0  # seconds membership must settle before rebalancing starts; overridden with --rebalance-delay
+REBALANCE_TIMEOUT = 3600.0  # seconds to wait for one copy to finish
+AUTH_SECRET = os.environ.get('DFS_AUTH_SECRET')  # signs session tokens and the rebalancer's requests; overridden with --auth-secret
+TOKEN_LIFETIME = 3600  # seconds a session token issued at login stays valid; overridden with --token-lifetime
+DB_POOL_SIZE = 4  # database connections kept open for logins
+DB_CONFIG = {  # the MySQL users database logins are checked against; overridden with --db-host, --db-user, --db-password, --db-name
+    'host': 'localhost',
+    'user': 'root',
+    'password': '',
+    'database': 'comp5504_users',
+}
+USERS_DATABASE = None  # path of a SQLite users database to check logins against instead of MySQL; overridden with --users-db
+REQUEST_TYPES = ('register', 'heartbeat', 'query', 'update', 'missed', 'stripe', 'login', 'stats', 'profile')  # others are counted as 'unknown'
+
+# Registered storage servers, the file location index and stripe layouts; persisted once opened
+metadata = MetadataStore()
 # Dynamically track storage servers
-storage_servers = {}
+storage_servers = metadata.servers
+# File key ('username/filename') -> ids of the storage servers holding that file
+file_locations = metadata.file_locations
+# File key -> stripe layout of a file striped across several storage servers
+file_layouts = metadata.file_layouts
+# Alive storage servers placed on a consistent-hash ring
+ring = HashRing()
+# Stamp of the current placement, changed whenever servers join, fail or come back or a file is striped.
+# Starts from the clock so that a restarted naming server never repeats an earlier stamp.
+placement_epoch = time.time_ns()
+# Min-heap of (deadline, server id); stale entries are skipped when popped
+expiry_heap = []
+expiry_condition = threading.Condition()
+# Set when servers join, fail or come back, to wake the rebalancer
+rebalance_needed = threading.Event()
+# File key -> last heartbeat stamp of the storage server that last reported storing it, to tell which copies a
+# returning server missed
+last_written = {}
+# (server id, file key) of copies a returning server holds but missed a write to; the rebalancer replaces or deletes them
+outdated_copies = set()
+# Pool of connections to the MySQL users database, opened on first login
+db_pool = None
+db_pool_lock = threading.Lock()
+profiler = SamplingProfiler()
 
-def client_handler(conn, client_ip):
-    """ Handle requests from connected clients. """
-    global storage_servers
-    try:
-        while True:
-            data = conn.recv(1024).decode()
-            if not data:
-                break
-            request = json.loads(data)
+HEADER_PREFIX = struct.Struct('!I')  # 4-byte big-endian length of the JSON message
 
-            if 'type' not in request:
-                response = {'status': 'error', 'message': 'Missing type information'}
-                conn.sendall(json.dumps(response).encode())
-                continue
+def recv_exact(conn, size):
+    """ Read exactly size bytes from the socket, or None if the peer closed first. """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = conn.recv_into(view[received:], size - received)
+        if count == 0:
+            return None
+        received += count
+    return bytes(buffer)
 
-            # Check for 'port' in requests that require it
-            if request['type'] in ['register', 'heartbeat'] and 'port' not in request:
-                response = {'status': 'error', 'message': 'Missing necessary port information for register or heartbeat'}
-                conn.sendall(json.dumps(response).encode())
-                continue
+def recv_message(conn):
+    """ Read one length-prefixed JSON message and its size in bytes, or (None, 0) once the peer disconnects. """
+    prefix = recv_exact(conn, HEADER_PREFIX.size)
+    if prefix is None:
+        return None, 0
+    (length,) = HEADER_PREFIX.unpack(prefix)
+    payload = recv_exact(conn, length)
+    if payload is None:
+        raise ConnectionError("Connection closed while reading message")
+    return json.loads(payload.decode()), HEADER_PREFIX.size + length
 
-            # Process requests based on their type
-            if request['type'] == 'register':
-                server_id = f"{client_ip}:{request['port']}"
-                storage_servers[server_id] = {'status': 'alive', 'files': [], 'last_heartbeat': time.time()}
-                response = {'status': 'registered'}
-            elif request['type'] == 'heartbeat':
-                server_id = f"{client_ip}:{request['port']}"
-                if server_id in storage_servers:
-                    storage_servers[server_id]['last_heartbeat'] = time.time()
-                    storage_servers[server_id]['status'] = 'alive'
-                response = {'status': 'heartbeat acknowledged'}
-            elif request['type'] == 'query':
-                response = handle_query()
-            elif request['type'] == 'update':
-                server_id = f"{client_ip}:{request['port']}"
-                response = handle_heartbeat(request, server_id)
-
-            conn.sendall(json.dumps(response).encode())
+def send_message(conn, message):
+    """ Send one length-prefixed JSON message; return its size in bytes. """
+    payload = json.dumps(message).encode()
+    conn.sendall(HEADER_PREFIX.pack(len(payload)) + payload)
+    return HEADER_PREFIX.size + len(payload)
+
+def process_request(request, client_ip):
+    """ Dispatch one decoded request and return the response to send back. """
+    if 'type' not in request:
+        response = {'status': 'error', 'message': 'Missing type information'}
+    # Check for 'port' in requests that require it
+    elif request['type'] in ['register', 'heartbeat'] and 'port' not in request:
+        response = {'status': 'error', 'message': 'Missing necessary port information for register or heartbeat'}
+    # Process requests based on their type
+    elif request['type'] == 'register':
+        server_id = f"{client_ip}:{request['port']}"
+        response = handle_register(request, server_id)
+    elif request['type'] == 'heartbeat':
+        server_id = f"{client_ip}:{request['port']}"
+        response = handle_heartbeat(request, server_id)
+    elif request['type'] == 'query':
+        response = handle_query(request)
+    elif request['type'] == 'update':
+        server_id = f"{client_ip}:{request['port']}"
+        response = handle_update(request, server_id)
+    elif request['type'] == 'missed':
+        response = handle_missed(request)
+    elif request['type'] == 'stripe':
+        response = handle_stripe(request)
+    elif request['type'] == 'login':
+        response = handle_login(request)
+    elif request['type'] == 'stats':
+        response = handle_stats(request)
+    elif request['type'] == 'profile':
+        response = dict(handle_profile(profiler, request), status='ok')
+    else:
+        response = {'status': 'error', 'message': f"Unknown request type {request['type']}"}
+
+    if 'id' in request:
+        response['id'] = request['id']
+    return response
+
+def start_timer(request, size):
+    """ Start timing a request, labelled by its type. """
+    timer = metrics.start(request.get('type') if request.get('type') in REQUEST_TYPES else 'unknown')
+    timer.bytes_in = size
+    return timer
+
+def client_handler(conn, client_ip, accepted=None):
+    """
+    Handle requests from connected clients. Connections are persistent: a peer may send
+    any number of requests, and may pipeline them without waiting for each reply. Each
+    response echoes the request's 'id' so the peer can match it to its request.
+    """
+    if accepted is not None:
+        metrics.record_accept(time.perf_counter() - accepted)
+    try:
+        while True:
+            request, size = recv_message(conn)
+            if request is None:
+                break
+            timer = start_timer(request, size)
+            with timer.phase('process'):
+                response = process_request(request, client_ip)
+            with timer.phase('send'):
+                timer.bytes_out = send_message(conn, response)
+            timer.failed = response.get('status') == 'error'
+            timer.finish()
     except Exception as e:
         print(f"Exception in client_handler: {e}")
     finally:
         conn.close()
 
-def handle_query():
-    """ Retrieve list of servers that are alive. """
+async def recv_message_async(reader):
+    """ Asyncio counterpart of recv_message. """
+    try:
+        prefix = await reader.readexactly(HEADER_PREFIX.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None, 0
+        raise ConnectionError("Connection closed while reading message")
+    (length,) = HEADER_PREFIX.unpack(prefix)
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed while reading message")
+    return json.loads(payload.decode()), HEADER_PREFIX.size + length
+
+async def async_client_handler(reader, writer, limiter, executor):
+    """
+    Serve one connection on the event loop. The limiter caps how many connections are
+    served at once; waiting on drain() stops us from buffering replies for a slow reader.
+    Requests are processed on the executor's threads: they take the metadata lock, which
+    a rebalancing plan holds while it walks the whole index, and may write and fsync the
+    metadata log, and neither may stall the other connections.
+    """
+    loop = asyncio.get_running_loop()
+    client_ip = writer.get_extra_info('peername')[0]
+    waiting = time.perf_counter()
+    async with limiter:
+        metrics.record_accept(time.perf_counter() - waiting)
+        try:
+            while True:
+                request, size = await recv_message_async(reader)
+                if request is None:
+                    break
+                timer = start_timer(request, size)
+                with timer.phase('process'):
+                    response = await loop.run_in_executor(executor, process_request, request, client_ip)
+                    payload = json.dumps(response).encode()
+                with timer.phase('send'):
+                    writer.write(HEADER_PREFIX.pack(len(payload)) + payload)
+                    await writer.drain()
+                timer.bytes_out = HEADER_PREFIX.size + len(payload)
+                timer.failed = response.get('status') == 'error'
+                timer.finish()
+        except Exception as e:
+            print(f"Exception in async_client_handler: {e}")
+        finally:
+            writer.close()
+
+def placement_changed():
+    """ Give the placement a new epoch, so clients drop locations they cached under the old one. Called with the metadata lock held. """
+    global placement_epoch
+    placement_epoch += 1
+
+def handle_register(request, server_id):
+    """ Register a storage server, index the files it already holds, and place it on the ring. """
+    with metadata.lock:
+        previous = storage_servers.get(server_id)
+        # A server that restarted before it was marked down may have missed writes since its last heartbeat too
+        down_since = None if previous is None else previous.get('down_since', previous['last_heartbeat'])
+        metadata.register_server(server_id, request.get('files', []))
+        forget_missed_writes(server_id, down_since)
+        ring.add(server_id)
+        schedule_expiry(server_id)
+        placement_changed()
+    rebalance_needed.set()
+    return {'status': 'registered'}
+
+def forget_missed_writes(server_id, down_since):
+    """
+    A server back from being down holds outdated copies of the files written meanwhile, and a server
+    that registers again may report whole copies of files striped since. Stop sending readers to those
+    copies and leave them to the rebalancer. Called with the metadata lock held.
+    """
+    files = storage_servers[server_id]['files']
+    outdated = files.intersection(file_layouts)
+    if down_since is not None:
+        outdated.update(key for key in files if last_written.get(key, 0) > down_since)
+    for key in outdated:
+        metadata.drop_file(server_id, key)
+        outdated_copies.add((server_id, key))
+
+def handle_query(request):
+    """
+    Locate servers for a request. Without a filename, every alive server is returned.
+    With one, 'servers' lists the alive replicas to read the file from (for a file not
+    stored anywhere yet, its owners on the hash ring) and 'replicas' lists where a write
+    must go: every current holder, topped up with ring owners to the replication factor.
+    A striped file also carries its 'layout', and a query with 'stripe' set lists the
+    servers a new striped upload should spread over.
+    Every reply carries a 'lease', the seconds the client may keep reusing it, and the
+    placement 'epoch' it was computed under.
+    A query with 'filenames' locates a batch of files at once and maps each name to its reply.
+    """
+    with metadata.lock:
+        if 'filenames' in request:
+            return {'files': {filename: locate(dict(request, filename=filename)) for filename in request['filenames']},
+                    'lease': LEASE_DURATION, 'epoch': placement_epoch}
+        return locate(request)
+
+def locate(request):
     alive_servers = [server for server, data in storage_servers.items() if data['status'] == 'alive']
-    return {'servers': alive_servers}
+    filename = request.get('filename')
+    if not filename:
+        return {'servers': rank(alive_servers), 'load': server_load(alive_servers),
+                'lease': LEASE_DURATION, 'epoch': placement_epoch}
+    key = file_key(request.get('username', ''), filename)
+    holders = [server for server in file_locations.get(key, ()) if server in alive_servers]
+    replicas = holders + new_replicas(key, holders, REPLICATION_FACTOR - len(holders), len(alive_servers))
+    response = {'servers': rank(holders or replicas), 'replicas': replicas, 'stored': bool(holders),
+                'load': server_load(set(holders) | set(replicas)), 'lease': LEASE_DURATION, 'epoch': placement_epoch}
+    if key in file_layouts:
+        response['layout'] = file_layouts[key]
+    if request.get('stripe'):
+        # Every alive server with room, in ring order from the file's owner, to spread stripes over
+        response['stripe_servers'] = [server for server in ring.nodes_for(key, len(alive_servers))
+                                      if has_room(storage_servers[server]['stats'], MIN_FREE_DISK)]
+    return response
+
+def new_replicas(key, holders, count, alive_count):
+    """
+    Up to count servers for new copies of a file: its ring owners in ring order, skipping current
+    holders and servers that are nearly full. The ring is only walked past the first owners if some
+    of them had to be skipped.
+    """
+    if count <= 0:
+        return []
+    for walked in (count + len(holders), alive_count):
+        candidates = [server for server in ring.nodes_for(key, walked) if server not in holders
+                      and has_room(storage_servers[server]['stats'], MIN_FREE_DISK)]
+        if len(candidates) >= count:
+            break
+    return candidates[:count]
+
+def rank(servers):
+    """ Order servers by the selection policy, the one to try first leading. """
+    return POLICIES[SELECTION_POLICY](servers, {server: storage_servers[server]['stats'] for server in servers})
+
+def server_load(servers):
+    """ The load figures most recently reported by each of the given servers. """
+    return {server: storage_servers[server]['stats'] for server in servers}
+
+def schedule_expiry(server_id):
+    """ Push back a server's expiry deadline by the heartbeat timeout. Called with the metadata lock held. """
+    deadline = time.monotonic() + HEARTBEAT_TIMEOUT
+    storage_servers[server_id]['deadline'] = deadline
+    with expiry_condition:
+        heapq.heappush(expiry_heap, (deadline, server_id))
+        # Only a new earliest deadline changes how long the monitor must sleep
+        if expiry_heap[0][1] == server_id:
+            expiry_condition.notify()
 
 def handle_heartbeat(request, server_id):
-    """ Update heartbeat for a registered server. """
+    """ Update heartbeat (and the reported load) for a registered server. """
+    with metadata.lock:
+        return record_heartbeat(request, server_id)
+
+def record_heartbeat(request, server_id):
     if server_id in storage_servers:
         storage_servers[server_id]['last_heartbeat'] = time.time()
-        storage_servers[server_id]['status'] = 'alive'
+        if 'stats' in request:
+            storage_servers[server_id]['stats'] = request['stats']
+        schedule_expiry(server_id)
+        if storage_servers[server_id]['status'] != 'alive':
+            storage_servers[server_id]['status'] = 'alive'
+            forget_missed_writes(server_id, storage_servers[server_id].pop('down_since', None))
+            ring.add(server_id)
+            placement_changed()
+            rebalance_needed.set()
         return {'status': 'heartbeat acknowledged'}
     else:
         return {'status': 'error', 'message': 'Server not registered'}
 
+def handle_update(request, server_id):
+    """
+    A storage server reports a file ('filename') or a batch of files ('filenames') it has just stored,
+    or, with 'removed' set, deleted.
+    """
+    filenames = request['filenames'] if 'filenames' in request else [request.get('filename', '')]
+    unstriped = False
+    with metadata.lock:
+        response = record_heartbeat(request, server_id)
+        if response['status'] == 'error':
+            return response
+        for filename in filenames:
+            key = file_key(request.get('username', ''), filename)
+            if request.get('removed'):
+                metadata.drop_file(server_id, key)
+            else:
+                # A whole copy replaces a striped version, whose stripes the rebalancer then deletes
+                unstriped = unstriped or key in file_layouts
+                metadata.record_file(server_id, key)
+                # The reporter's own heartbeat stamp, so its copy never looks like it missed this write
+                last_written[key] = storage_servers[server_id]['last_heartbeat']
+        if unstriped:
+            placement_changed()
+    if unstriped:
+        rebalance_needed.set()
+    return {'status': 'update recorded'}
+
+def handle_missed(request):
+    """
+    A client's write did not reach some replicas ('files' maps each filename to them). Copies those
+    servers still hold are older than the one just written: stop sending readers to them and leave
+    them to the rebalancer, which copies the new version over them.
+    """
+    username = request.get('username', '')
+    dropped = False
+    with metadata.lock:
+        for filename, servers in request.get('files', {}).items():
+            key = file_key(username, filename)
+            for server in servers:
+                if server in file_locations.get(key, ()):
+                    metadata.drop_file(server, key)
+                    outdated_copies.add((server, key))
+                    dropped = True
+        if dropped:
+            placement_changed()
+    if dropped:
+        rebalance_needed.set()
+    return {'status': 'missed writes recorded'}
+
+def handle_stripe(request):
+    """
+    A client finished a striped upload: record which servers hold each stripe. Whole copies
+    stored before are superseded, so the file is dropped from the location index and the
+    rebalancer deletes them, along with stripes of an earlier layout past the new count.
+    """
+    if not all(field in request for field in ('filename', 'size', 'stripe_size', 'stripes')):
+        return {'status': 'error', 'message': 'Missing stripe layout information'}
+    key = file_key(request.get('username', ''), request['filename'])
+    with metadata.lock:
+        outdated_copies.update((server, key) for server in file_locations.get(key, ()))
+        metadata.record_layout(key, {'size': request['size'], 'stripe_size': request['stripe_size'],
+                                     'stripes': request['stripes']})
+        last_written[key] = time.time()
+        placement_changed()
+        epoch = placement_epoch
+    rebalance_needed.set()
+    return {'status': 'layout recorded', 'epoch': epoch}
+
+def handle_login(request):
+    """
+    Check a user's password and return a session token for the storage servers. Without an auth secret
+    the storage servers take each request's username on trust, and the token is None.
+    """
+    username, password = request.get('username'), request.get('password')
+    if not isinstance(username, str) or not isinstance(password, str):
+        return {'status': 'error', 'message': 'A login needs a username and a password'}
+    try:
+        stored_password = find_password(username)
+    except (sqlite3.Error, OSError) + database_errors() as e:
+        print(f"Failed to query the users database: {e}")
+        return {'status': 'error', 'message': 'The users database is unavailable'}
+    if stored_password is None:
+        return {'status': 'error', 'message': 'Username not found'}
+    if not hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored_password):
+        return {'status': 'error', 'message': 'Password is incorrect'}
+    token = issue_token(AUTH_SECRET, username, TOKEN_LIFETIME) if AUTH_SECRET is not None else None
+    return {'status': 'logged in', 'token': token}
+
+def database_errors():
+    """ The exceptions the MySQL driver raises, if it is installed. """
+    return (mysql.connector.Error,) if mysql is not None else ()
+
+def find_password(username):
+    """ The stored password hash of a user, or None for an unknown user. """
+    if USERS_DATABASE is not None:
+        connection = sqlite3.connect(USERS_DATABASE)
+        try:
+            record = connection.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        finally:
+            connection.close()
+        return record and record[0]
+    global db_pool
+    if mysql is None:
+        raise OSError("mysql-connector-python is not installed; use --users-db for a SQLite users database")
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name='dfs_auth', pool_size=DB_POOL_SIZE,
+                                                                  **DB_CONFIG)
+    connection = db_pool.get_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
+            record = cursor.fetchone()
+        finally:
+            cursor.close()
+    finally:
+        connection.close()  # back to the pool
+    return record and record[0]
+
+def handle_stats(request):
+    """ The naming server's request metrics, as JSON or (with 'format': 'prometheus') as Prometheus text. """
+    if request.get('format') == 'prometheus':
+        return {'status': 'ok', 'text': metrics.render()}
+    return dict(metrics.snapshot(), status='ok')
+
+def placement_gauges():
+    """ Levels exported with the metrics. """
+    with metadata.lock:
+        alive = sum(data['status'] == 'alive' for data in storage_servers.values())
+        return {'servers_alive': alive, 'servers_down': len(storage_servers) - alive,
+                'files_indexed': len(file_locations), 'files_striped': len(file_layouts)}
+
+metrics = Metrics('dfs_naming', placement_gauges)
+
 def monitor_servers():
-    """ Monitor and update the status of registered servers. """
+    """
+    Mark servers down once their heartbeat deadline passes. Deadlines sit in a min-heap, so
+    the monitor sleeps until the earliest one and only ever looks at servers that expired.
+    Heartbeats push a fresh deadline rather than removing the old one; entries that no longer
+    match the server's current deadline are simply discarded when they surface.
+    """
     while True:
-        current_time = time.time()
-        for server, data in list(storage_servers.items()):
-            if current_time - data['last_heartbeat'] > 50:  # Assume 50 seconds timeout
-                data['status'] = 'down'
-        time.sleep(5)
+        with expiry_condition:
+            while not expiry_heap or expiry_heap[0][0] > time.monotonic():
+                expiry_condition.wait(expiry_heap[0][0] - time.monotonic() if expiry_heap else None)
+            deadline, server = heapq.heappop(expiry_heap)
+        # Deadlines are written under the metadata lock, which is always taken before expiry_condition
+        with metadata.lock:
+            data = storage_servers.get(server)
+            if data is None or data.get('deadline') != deadline or data['status'] != 'alive':
+                continue
+            data['status'] = 'down'
+            # Writes after its last heartbeat may already have missed it
+            data['down_since'] = data['last_heartbeat']
+            ring.remove(server)
+            placement_changed()
+        rebalance_needed.set()
+        print(f"Storage server {server} missed its heartbeat deadline and is marked down")
+
+def plan_rebalance():
+    """
+    The copies that bring every file back to the replication factor on its ring owners, as
+    (action, file key, source server, target server) tuples, most urgent first:
+    - 'copy': a file with fewer alive copies than it should have is copied from its least
+      loaded holder to new replicas;
+    - 'move': a fully replicated file held by a server that is not one of its ring owners,
+      while an owner lacks it, moves there, so a new server takes its share of existing files;
+    - 'delete': copies beyond the replication factor on servers that are not owners (say, a
+      server that came back after its files were re-replicated) are removed, as are outdated
+      copies on servers that are not owners; owners get a fresh copy over their outdated one.
+    Stripes are copied the same way when they lose copies, but never moved: the layout says where
+    they are, and copies on servers it does not list are deleted once the listed ones suffice.
+    Stripes no layout lists are deleted once their file was written after them; whole copies of
+    a striped file are always outdated.
+    """
+    with metadata.lock:
+        alive = {server for server, data in storage_servers.items() if data['status'] == 'alive'}
+        wanted = min(REPLICATION_FACTOR, len(alive))
+        copies, moves, deletes = [], [], []
+        for key, holders in file_locations.items():
+            listed = None
+            if stripe_of(key) is not None:
+                listed = stripe_servers(*stripe_of(key))
+                if listed is None:
+                    if stripe_superseded(key):
+                        deletes.extend(('delete', key, server, None) for server in holders if server in alive)
+                    continue  # otherwise part of an unfinished upload
+            alive_holders = [server for server in holders if server in alive]
+            # Unlisted copies of a stripe may be of an older version, so are never copied from
+            current = alive_holders if listed is None else [server for server in alive_holders if server in listed]
+            if not current:
+                continue  # nothing to copy from until a holder comes back
+            if len(current) < wanted:
+                source = rank(current)[0]
+                for target in new_replicas(key, alive_holders, wanted - len(current), len(alive)):
+                    copies.append(('copy', key, source, target))
+                continue
+            if listed is not None:
+                if len(current) >= wanted:
+                    for source in alive_holders:
+                        if source not in listed:
+                            deletes.append(('delete', key, source, None))
+                continue
+            owners = ring.nodes_for(key, wanted)
+            lacking = [server for server in owners if server not in alive_holders
+                       and has_room(storage_servers[server]['stats'], MIN_FREE_DISK)]
+            surplus = [server for server in alive_holders if server not in owners]
+            for source, target in zip(surplus, lacking):
+                moves.append(('move', key, source, target))
+            for source in surplus[len(lacking):][:len(alive_holders) - wanted]:
+                deletes.append(('delete', key, source, None))
+        for server, key in list(outdated_copies):
+            if server not in alive:
+                continue
+            outdated_copies.discard((server, key))
+            if key in file_layouts:
+                keepers = ()  # a whole copy of a file striped since
+            elif stripe_of(key) is None:
+                keepers = ring.nodes_for(key, wanted)
+            else:
+                keepers = stripe_servers(*stripe_of(key)) or ()
+            if server not in file_locations.get(key, ()) and server not in keepers:
+                deletes.append(('delete', key, server, None))
+        return copies + moves + deletes
+
+def stripe_of(key):
+    """ The file key and stripe number of a stripe's key ('username/.filename.stripeN'), or None for other keys. """
+    username, name = key.split('/', 1)
+    filename, separator, index = name[1:].rpartition('.stripe')
+    if not name.startswith('.') or not separator or not index.isdigit():
+        return None
+    return file_key(username, filename), int(index)
+
+def stripe_servers(key, index):
+    """ The servers the layout of file key lists for one of its stripes, or None if it has no such stripe. Called with the metadata lock held. """
+    layout = file_layouts.get(key)
+    if layout is None or index >= len(layout['stripes']):
+        return None
+    return layout['stripes'][index]
+
+def stripe_superseded(stripe_key):
+    """
+    Whether a stripe no layout lists was stored before its file was last written (whole, or with
+    fewer stripes), rather than by an upload still in progress. Called with the metadata lock held.
+    """
+    return last_written.get(stripe_key, 0) < last_written.get(stripe_of(stripe_key)[0], 0)
+
+def record_stripe_copy(stripe_key, target):
+    """
+    List a new copy of a stripe in its file's layout, in place of the copies on servers that are down or
+    no longer hold it, so readers find it. Placement changes, so clients drop layouts they cached.
+    """
+    key, index = stripe_of(stripe_key)
+    with metadata.lock:
+        listed = stripe_servers(key, index)
+        if listed is None:
+            return
+        holders = file_locations.get(stripe_key, ())
+        kept = [server for server in listed if server != target and server in holders
+                and storage_servers.get(server, {}).get('status') == 'alive']
+        layout = file_layouts[key]
+        stripes = list(layout['stripes'])
+        stripes[index] = kept + [target]
+        metadata.record_layout(key, dict(layout, stripes=stripes))
+        placement_changed()
+
+def run_rebalance_job(job):
+    """ Ask a storage server to copy, move or delete one file. Return whether it did. """
+    action, key, source, target = job
+    username, filename = key.split('/', 1)
+    request = {'op': 'DELETE' if action == 'delete' else 'REPLICATE', 'filename': filename, 'username': username}
+    if action != 'delete':
+        request.update(target=target, rate=REBALANCE_BANDWIDTH / REBALANCE_JOBS, move=action == 'move')
+    if AUTH_SECRET is not None:
+        request['token'] = issue_token(AUTH_SECRET, username, REBALANCE_TIMEOUT)
+    host, port = source.rsplit(':', 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=REBALANCE_TIMEOUT) as conn:
+            send_message(conn, request)
+            response, size = recv_message(conn)
+    except (OSError, ValueError) as e:
+        print(f"Failed to {action} {key} on {source}: {e}")
+        return False
+    if response is None:
+        print(f"Failed to {action} {key} on {source}: connection closed")
+        return False
+    if response.get('status') == 'FILE_NOT_FOUND':
+        # The index was wrong about this holder; forget it so the next plan picks another source
+        with metadata.lock:
+            metadata.drop_file(source, key)
+        return False
+    if response.get('status') not in ('REPLICATED', 'DELETED'):
+        print(f"Failed to {action} {key} on {source}: {response.get('message', response.get('status'))}")
+        return False
+    if action == 'copy' and stripe_of(key) is not None:
+        record_stripe_copy(key, target)
+    return True
+
+def rebalancer():
+    """
+    Rebalance after membership changes. Once woken, the rebalancer waits REBALANCE_DELAY so that
+    a burst of changes (or a server that is only restarting) is handled in one pass, then runs
+    the planned jobs REBALANCE_JOBS at a time. Storage servers report the copies they store and
+    delete, so the location index follows along. Failed jobs are planned again after another delay.
+    """
+    executor = ThreadPoolExecutor(max_workers=REBALANCE_JOBS, thread_name_prefix='rebalance')
+    while True:
+        rebalance_needed.wait()
+        rebalance_needed.clear()
+        time.sleep(REBALANCE_DELAY)
+        jobs = plan_rebalance()
+        if not jobs:
+            continue
+        print(f"Rebalancing: {len(jobs)} jobs")
+        succeeded = sum(executor.map(run_rebalance_job, jobs))
+        print(f"Rebalancing finished: {succeeded} of {len(jobs)} jobs succeeded")
+        if succeeded < len(jobs):
+            rebalance_needed.set()
+
+def recover_metadata(directory):
+    """
+    Reload the saved metadata. Recovered servers count as alive until they miss a
+    heartbeat deadline, so queries are answered correctly right after a restart.
+    """
+    if directory is None:
+        return
+    with metadata.lock:
+        metadata.open(directory)
+        for server_id in storage_servers:
+            ring.add(server_id)
+            schedule_expiry(server_id)
 
 def start_server(host, port):
     """ Start the naming server listening on the given host and port. """
     server_thread = threading.Thread(target=monitor_servers)
     server_thread.start()
+    if REBALANCE_JOBS > 0:
+        threading.Thread(target=rebalancer, daemon=True).start()
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # Persistent connections of a previous run may still hold the port in TIME_WAIT
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
         s.listen()
         print(f"Naming Server listening on {host}:{port}")
         while True:
             conn, addr = s.accept()
+            accepted = time.perf_counter()
             print(f"Connected by {addr}")
-            thread = threading.Thread(target=client_handler, args=(conn, addr[0]))
+            # Replies must not wait for the peer's delayed ACK on persistent connections; asyncio sets this itself
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=client_handler, args=(conn, addr[0], accepted))
             thread.start()
 
+async def serve_async(host, port, max_connections):
+    limiter = asyncio.Semaphore(max_connections)
+    executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS, thread_name_prefix='naming-request')
+    server = await asyncio.start_server(lambda reader, writer: async_client_handler(reader, writer, limiter, executor),
+                                        host, port, backlog=1024)
+    print(f"Naming Server (asyncio) listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(host, port, max_connections=MAX_CONNECTIONS):
+    """ Start the naming server on a single asyncio event loop instead of a thread per connection. """
+    server_thread = threading.Thread(target=monitor_servers, daemon=True)
+    server_thread.start()
+    if REBALANCE_JOBS > 0:
+        threading.Thread(target=rebalancer, daemon=True).start()
+    asyncio.run(serve_async(host, port, max_connections))
+
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python server.py [host] [port]")
-        sys.exit(1)
-    host = sys.argv[1]
-    port = int(sys.argv[2])
-    start_server(host, port)
+    parser = argparse.ArgumentParser(description="Naming server for the distributed file system")
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="serve each connection on its own thread, or all of them on one asyncio event loop")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="connections served at once in async mode; further connections wait")
+    parser.add_argument('--replicas', type=int, default=REPLICATION_FACTOR,
+                        help="number of storage servers each file is written to")
+    parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_TIMEOUT,
+                        help="seconds without a heartbeat before a storage server is marked down (may be below 1)")
+    parser.add_argument('--selection', choices=sorted(POLICIES), default=SELECTION_POLICY,
+                        help="how servers returned by queries are ranked by their reported load")
+    parser.add_argument('--min-free-disk', type=int, default=MIN_FREE_DISK,
+                        help="bytes of free disk below which a storage server receives no new files")
+    parser.add_argument('--lease', type=float, default=LEASE_DURATION,
+                        help="seconds clients may cache a query result; 0 disables client caching")
+    parser.add_argument('--metadata-dir', default=METADATA_DIRECTORY,
+                        help="directory for the metadata log and snapshots")
+    parser.add_argument('--no-persist', action='store_true',
+                        help="keep metadata in memory only; it is lost on restart")
+    parser.add_argument('--fsync', action='store_true',
+                        help="fsync the metadata log after every change")
+    parser.add_argument('--rebalance-jobs', type=int, default=REBALANCE_JOBS,
+                        help="copies between storage servers run at once when rebalancing; 0 disables rebalancing")
+    parser.add_argument('--rebalance-bandwidth', type=int, default=REBALANCE_BANDWIDTH,
+                        help="bytes/s shared by all rebalancing copies")
+    parser.add_argument('--rebalance-delay', type=float, default=REBALANCE_DELAY,
+                        help="seconds to let membership changes settle before rebalancing")
+    parser.add_argument('--auth-secret', default=AUTH_SECRET,
+                        help="secret session tokens are signed with, shared only with the storage servers "
+                             "(default: $DFS_AUTH_SECRET); without one, logins return no token")
+    parser.add_argument('--token-lifetime', type=int, default=TOKEN_LIFETIME,
+                        help="seconds a session token issued at login stays valid")
+    parser.add_argument('--db-host', default=DB_CONFIG['host'], help="host of the MySQL users database")
+    parser.add_argument('--db-user', default=DB_CONFIG['user'], help="MySQL user logins query the database as")
+    parser.add_argument('--db-password', default=DB_CONFIG['password'], help="password of that MySQL user")
+    parser.add_argument('--db-name', default=DB_CONFIG['database'], help="name of the MySQL users database")
+    parser.add_argument('--users-db',
+                        help="check logins against the users table of this SQLite file instead of MySQL")
+    parser.add_argument('--metrics-port', type=int,
+                        help="also serve the request metrics in Prometheus text format over HTTP on this port")
+    args = parser.parse_args()
+    REPLICATION_FACTOR = args.replicas
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    LEASE_DURATION = args.lease
+    SELECTION_POLICY = args.selection
+    MIN_FREE_DISK = args.min_free_disk
+    REBALANCE_JOBS = args.rebalance_jobs
+    REBALANCE_BANDWIDTH = args.rebalance_bandwidth
+    REBALANCE_DELAY = args.rebalance_delay
+    AUTH_SECRET = args.auth_secret
+    TOKEN_LIFETIME = args.token_lifetime
+    DB_CONFIG.update(host=args.db_host, user=args.db_user, password=args.db_password, database=args.db_name)
+    USERS_DATABASE = args.users_db
+    metadata.sync = args.fsync
+    recover_metadata(None if args.no_persist else args.metadata_dir)
+    if args.metrics_port:
+        serve_metrics(args.host, args.metrics_port, metrics)
+    if args.mode == 'async':
+        start_async_server(args.host, args.port, args.max_connections)
+    else:
+        start_server(args.host, args.port)
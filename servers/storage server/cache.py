@@ -0,0 +1,159 @@
+"""
+In-memory cache of hot files for the storage server.
+
+CachedStore wraps either storage backend and keeps the contents of small, recently read files and
+each user's file listing in memory, bounded by a total size in bytes and evicted least recently used
+first. A cache hit serves a GET or LIST without touching the file system. Files stored compressed are cached
+decompressed, so hits never need decoding. Every PUT (or manifest)
+that commits, and every deletion, drops the cached copy of that file and the owner's listing, so readers never
+see a file older than the last completed upload. A fill that read a file or listing before such a change is
+discarded; changes to other files leave it alone. Hit, miss and eviction counters are reported with heartbeats.
+"""
+
+
+import threading
+from collections import OrderedDict
+
+from stores import range_response
+
+CACHE_SIZE = 64 * 1024 * 1024  # bytes of file contents and listings kept in memory
+MAX_CACHED_FILE = 1024 * 1024  # larger files are always served from disk
+LISTING_ENTRY_OVERHEAD = 64  # bytes charged per name in a cached listing, on top of the name itself
+RECENT_INVALIDATIONS = 4096  # invalidated keys remembered; fills begun before an older invalidation are discarded
+
+class CachedUpload:
+    """ An upload that drops the stale cached copy of its file once it commits. """
+
+    def __init__(self, cache, upload, username, filepath):
+        self.cache = cache
+        self.upload = upload
+        self.username = username
+        self.filepath = filepath
+
+    def write(self, data):
+        self.upload.write(data)
+
+    def commit(self):
+        self.upload.commit()
+        self.cache.invalidate(self.username, self.filepath)
+
+    def abort(self):
+        self.upload.abort()
+
+class CachedStore:
+    """ A storage backend with an LRU cache of small files and listings in front of it. """
+
+    def __init__(self, backend, capacity=CACHE_SIZE, max_file_size=MAX_CACHED_FILE):
+        self.backend = backend
+        self.capacity = capacity
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()  # ('file', username, filepath) or ('list', username) -> (value, cost)
+        self.used = 0
+        self.invalidations = 0  # bumped by every invalidation; a fill remembers its value when it starts
+        self.invalidated = OrderedDict()  # key -> value of invalidations when it was last invalidated, oldest first
+        self.forgotten = 0  # the latest invalidation dropped from invalidated
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Block store operations (HAS_BLOCKS, PUT_BLOCK) go straight to the backend
+        return getattr(self.backend, name)
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, self.invalidations
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], None
+
+    def insert(self, key, value, cost, generation):
+        """ Cache value unless it no longer fits or its key was invalidated since the fill started. """
+        with self.lock:
+            if cost > self.capacity or self.invalidated.get(key, self.forgotten) > generation:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.used -= previous[1]
+            self.entries[key] = (value, cost)
+            self.used += cost
+            while self.used > self.capacity:
+                self.used -= self.entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def invalidate(self, username, filepath):
+        with self.lock:
+            self.invalidations += 1
+            for key in (('file', username, filepath), ('list', username)):
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.used -= entry[1]
+                self.invalidated.pop(key, None)
+                self.invalidated[key] = self.invalidations
+            while len(self.invalidated) > RECENT_INVALIDATIONS:
+                self.forgotten = self.invalidated.popitem(last=False)[1]
+
+    def counters(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.used}
+
+    def begin_put(self, username, filepath, codec=None, size=None):
+        return CachedUpload(self, self.backend.begin_put(username, filepath, codec, size), username, filepath)
+
+    def write_manifest(self, username, filepath, blocks):
+        self.backend.write_manifest(username, filepath, blocks)
+        self.invalidate(username, filepath)
+
+    def prepare_get(self, username, filepath, offset=0, count=None, accept=()):
+        key = ('file', username, filepath)
+        data, generation = self.lookup(key)
+        if data is None:
+            details = self.backend.file_details(username, [filepath])[filepath]
+            if details is None or details['size'] is None or details['size'] > self.max_file_size:
+                # Missing, striped or too large to cache: skip reading it whole (and decompressing it)
+                return self.backend.prepare_get(username, filepath, offset, count, accept)
+            response, segments = self.backend.prepare_get(username, filepath)
+            if segments is None:
+                return response, None
+            if response['size'] > self.max_file_size:
+                for source, segment_offset, length in segments:
+                    if not isinstance(source, str):
+                        source.close()
+                # It grew since we looked: let the backend serve the requested range as usual
+                return self.backend.prepare_get(username, filepath, offset, count, accept)
+            data = read_segments(segments)
+            self.insert(key, data, len(data), generation)
+        response = range_response(len(data), offset, count)
+        if response['status'] != 'OK':
+            return response, None
+        return response, [(data, offset, response['length'])]
+
+    def list_files(self, username):
+        key = ('list', username)
+        files, generation = self.lookup(key)
+        if files is None:
+            files = self.backend.list_files(username)
+            self.insert(key, files, sum(len(name) + LISTING_ENTRY_OVERHEAD for name in files), generation)
+        return files
+
+    def delete(self, username, filepath):
+        deleted = self.backend.delete(username, filepath)
+        self.invalidate(username, filepath)
+        return deleted
+
+    def stored_files(self):
+        return self.backend.stored_files()
+
+def read_segments(segments):
+    """ Read the (open file or path, offset, length) segments of a GET body into memory. """
+    data = bytearray()
+    for source, offset, length in segments:
+        with (open(source, 'rb') if isinstance(source, str) else source) as f:
+            f.seek(offset)
+            data += f.read(length)
+    return bytes(data)
@@ -5,134 +5,1058 @@ on a specified IP and port, handling each connection in a separate thread.
 
 Features:
 - Handles file operations including writing files (PUT), reading files (GET), and listing all files in the directory (LIST).
-- Registers itself with a central naming server and periodically sends heartbeats to maintain its 'alive' status.
+  MPUT and MGET move up to 256 files in a single request, and LIST is paginated with a cursor, can filter by name prefix
+  and can return each file's size and modification time.
+- Speaks a length-prefixed framing protocol: a JSON header carrying the opcode, file name, user and payload length, followed by
+  the payload streamed in fixed-size chunks, so files of any size and content move without being held in memory.
+- Serves GET (optionally a byte range of the file) with sendfile, falling back to mmap, so file bytes go from the page cache
+  to the socket without being copied through Python.
+- Registers itself with a central naming server and periodically pushes heartbeats to maintain its 'alive' status, reusing one
+  persistent connection to the naming server instead of reconnecting for every message. Each heartbeat carries the server's
+  load (free and total disk, active connections, requests in flight, connections queued, moving-average request latency,
+  bytes/s), which the naming server ranks servers by; the interval is set with `--heartbeat-interval`.
+- Reports the files it holds when it registers and every file it stores afterwards, so the naming server can route
+  queries for a file to the server that has it. Reports are sent in batches from a background thread, so replies to
+  clients never wait on the naming server.
+- Accepts uploads compressed with zlib or lzma (negotiated per request with CODECS) and keeps them compressed on disk,
+  sending them as stored to clients that accept the codec and decompressed to the rest.
+- Verifies the signed, expiring session token carried by every request locally (`--auth-secret`), with no database
+  round trip, and serves each request as the user the token was issued to. Tokens are issued by the naming server
+  when a user logs in.
 - Uses a base directory to store all files, isolating stored data from the system to improve security and organization.
+- Keeps small, frequently read files and per-user listings in a size-bounded LRU cache in memory (`--cache-size`), so
+  popular files are served without touching the disk; uploads invalidate the cached copies, and hit/miss/eviction
+  counters are reported with every heartbeat.
+- Optionally (`--backend blocks`) stores files as deduplicated, content-addressed blocks with per-user manifests, and lets
+  clients upload only the blocks it does not already hold. Blocks no file uses any more are deleted by a periodic
+  mark-and-sweep pass (`--gc-interval`).
+- Copies a file to another storage server on the naming server's behalf (REPLICATE), throttled to a given rate so
+  that rebalancing leaves bandwidth for clients, optionally deleting its own copy afterwards; DELETE removes a file.
+  Removals are reported to the naming server like new files are.
+- Times every request and the phases it spends receiving, on disk and sending, and counts
+  bytes in and out per operation. STATS returns the figures (as JSON, or Prometheus text with 'format': 'prometheus'),
+  `--metrics-port` serves them over HTTP at /metrics, and PROFILE starts and stops a sampling profiler at runtime.
 
 Usage:
 To run the server, provide the local host IP, local port, naming server host IP, naming server port, and path to the storage directory
 as command-line arguments. For example:
     python storage_server.py 127.0.0.1 10000 127.0.0.1 9999 
+Add `--mode async` to serve all connections from one asyncio event loop, with file I/O offloaded to a bounded worker pool,
+instead of starting a thread per connection.
 """
 
 
+import argparse
+import asyncio
+import bisect
+import itertools
+import queue
 import socket
 import threading
 import time
 import json
+import mmap
 import os
+import shutil
+import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
-def handle_client(conn, base_directory):
-    while True:
-        try:
-            data = conn.recv(1024).decode()
-        except:
-            pass
-        
+# Modules shared with the naming server and the client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+
+from auth import issue_token, verify_token
+from cache import CACHE_SIZE, CachedStore
+from metrics import Metrics, SamplingProfiler, handle_profile, serve_metrics
+from stores import MAX_BLOCK_SIZE, BlockStore, FileStore
+
+HEADER_PREFIX = struct.Struct('!I')  # 4-byte big-endian length of the JSON header
+CHUNK_SIZE = 64 * 1024  # bytes moved per read/write while streaming a body
+MAX_CONNECTIONS = 16384  # connections served at once in async mode
+IO_WORKERS = 32  # threads doing blocking file I/O in async mode
+HEARTBEAT_INTERVAL = 5.0  # seconds between heartbeats
+GC_INTERVAL = 3600.0  # seconds between sweeps of unreferenced blocks in the block store
+LATENCY_WEIGHT = 0.2  # weight of the newest request in the moving-average latency reported to the naming server
+BLOCK_COMMANDS = ('HAS_BLOCKS', 'PUT_BLOCK', 'PUT_MANIFEST')  # only served by the block store
+COMMANDS = ('PUT', 'GET', 'CODECS', 'LIST', 'MPUT', 'MGET', 'DELETE', 'REPLICATE', 'STATS', 'PROFILE') + BLOCK_COMMANDS  # others are counted as UNKNOWN
+REPLICATE_ATTEMPTS = 3  # times a file that keeps changing while it is copied to a peer is copied again
+PEER_TIMEOUT = 60.0  # seconds to wait on a peer storage server before giving up a copy
+MAX_BATCH_FILES = 256  # files in one MPUT or MGET
+REPORT_BATCH_FILES = 1000  # most stored or removed files reported to the naming server at once
+LIST_PAGE_SIZE = 1000  # most names returned by one LIST
+AUTH_SECRET = os.environ.get('DFS_AUTH_SECRET')  # when set, requests must carry a session token; overridden with --auth-secret
+
+def no_delay(sock):
+    """
+    Turn off Nagle's algorithm. Headers and bodies are sent as separate writes, and on a persistent
+    connection Nagle would hold back the second one until the peer's delayed ACK, some 40 ms later.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def recv_exact(conn, size):
+    """ Read exactly size bytes from the socket, or None if the peer closed first. """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = conn.recv_into(view[received:], size - received)
+        if count == 0:
+            return None
+        received += count
+    return bytes(buffer)
+
+def recv_header(conn):
+    """ Read one frame header: a length prefix followed by a JSON object. """
+    prefix = recv_exact(conn, HEADER_PREFIX.size)
+    if prefix is None:
+        return None
+    (header_length,) = HEADER_PREFIX.unpack(prefix)
+    payload = recv_exact(conn, header_length)
+    if payload is None:
+        raise ConnectionError("Connection closed while reading header")
+    return json.loads(payload.decode())
+
+def send_header(conn, header):
+    """ Send one frame header. The body, if any, is streamed separately. """
+    payload = json.dumps(header).encode()
+    conn.sendall(HEADER_PREFIX.pack(len(payload)) + payload)
+
+def recv_body_to_file(conn, f, length):
+    """ Stream length bytes of body from the socket into a binary file or upload. """
+    buffer = bytearray(min(CHUNK_SIZE, length) or 1)
+    view = memoryview(buffer)
+    remaining = length
+    while remaining > 0:
+        count = conn.recv_into(view, min(len(buffer), remaining))
+        if count == 0:
+            raise ConnectionError("Connection closed while receiving body")
+        f.write(view[:count])
+        remaining -= count
+
+def discard_body(conn, length):
+    """ Drain a body we cannot store so the next frame stays aligned. """
+    remaining = length
+    while remaining > 0:
+        data = conn.recv(min(CHUNK_SIZE, remaining))
         if not data:
+            raise ConnectionError("Connection closed while discarding body")
+        remaining -= len(data)
+
+def send_file_range(conn, f, offset, count):
+    """
+    Send count bytes of an open binary file starting at offset without copying them through Python.
+    sendfile(2) hands pages straight from the page cache to the socket; where it is unavailable the
+    range is mapped with mmap and written from the mapping.
+    """
+    if count == 0:
+        return
+    if hasattr(os, 'sendfile'):
+        sent = conn.sendfile(f, offset, count)
+        if sent != count:
+            raise IOError("File shrank while it was being sent")
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if len(mapped) < offset + count:
+            raise IOError("File shrank while it was being sent")
+        with memoryview(mapped) as view:
+            conn.sendall(view[offset:offset + count])
+
+def reply(conn, request_id, response):
+    """ Send a response header, echoing the request id so pipelined replies can be matched. """
+    if request_id is not None:
+        response['id'] = request_id
+    send_header(conn, response)
+
+def send_segments(conn, segments):
+    """ Send the (open file, path or cached bytes, offset, length) segments of a GET body in order. """
+    for source, offset, length in segments:
+        if isinstance(source, bytes):
+            conn.sendall(memoryview(source)[offset:offset + length])
+            continue
+        with (open(source, 'rb') if isinstance(source, str) else source) as f:
+            send_file_range(conn, f, offset, length)
+
+class TimedUpload:
+    """ Charges the time an upload spends writing to the 'disk' phase of its request, rather than to receiving. """
+
+    def __init__(self, upload, timer):
+        self.upload = upload
+        self.timer = timer
+
+    def write(self, data):
+        with self.timer.phase('disk'):
+            self.upload.write(data)
+
+def handle_put(conn, store, filepath, username, length, timer, codec=None, size=None):
+    if codec is not None and codec not in store.codecs:
+        discard_body(conn, length)
+        return {'status': 'ERROR', 'message': f"Unsupported codec {codec}"}
+    try:
+        with timer.phase('disk'):
+            upload = store.begin_put(username, filepath, codec, size)
+    except IOError as e:
+        discard_body(conn, length)
+        return {'status': 'ERROR', 'message': e.strerror}
+    except ValueError as e:
+        discard_body(conn, length)
+        return {'status': 'ERROR', 'message': str(e)}
+    try:
+        with timer.phase('recv'):
+            recv_body_to_file(conn, TimedUpload(upload, timer), length)
+        with timer.phase('disk'):
+            upload.commit()
+    except Exception:
+        upload.abort()
+        raise
+    return {'status': 'PUT_COMPLETE'}
+
+def handle_get(conn, store, request_id, filepath, username, timer, offset=0, count=None, accept=()):
+    with timer.phase('disk'):
+        response, segments = store.prepare_get(username, filepath, offset, count, accept)
+    with timer.phase('send'):
+        reply(conn, request_id, response)
+        if segments is not None:
+            stats.add_bytes(response['length'])
+            timer.bytes_out = response['length']
+            send_segments(conn, segments)
+
+def authenticate(request):
+    """
+    The user a request acts for. When session tokens are required this comes from the request's
+    verified 'token' (None if it is missing, forged or expired); otherwise from its 'username'.
+    """
+    if AUTH_SECRET is None:
+        return request.get('username', '')
+    return verify_token(AUTH_SECRET, request.get('token'))
+
+def check_batch(request):
+    """ Return why an MPUT or MGET request is malformed, or None if it is fine. """
+    files = request.get('files')
+    if not isinstance(files, list) or len(files) > MAX_BATCH_FILES:
+        return f"A batch must list at most {MAX_BATCH_FILES} files"
+    if request.get('op') == 'MPUT':
+        if not all(isinstance(entry, dict) for entry in files):
+            return "Every file of an MPUT needs a filename and a length"
+        if sum(entry.get('length', 0) for entry in files) != request.get('length', 0):
+            return "File lengths do not add up to the body length"
+    return None
+
+def handle_mput(conn, store, username, files, link, timer):
+    """ Store a batch of files whose bodies follow the header back to back, then report them in one update. """
+    stored, failed = [], {}
+    for entry in files:
+        filepath = entry.get('filename', '')
+        response = handle_put(conn, store, filepath, username, entry.get('length', 0), timer, entry.get('codec'),
+                              entry.get('size'))
+        if response['status'] == 'PUT_COMPLETE':
+            stored.append(filepath)
+        else:
+            failed[filepath] = response.get('message')
+    report_stored_files(link, username, stored)
+    return {'status': 'ERROR' if failed else 'PUT_COMPLETE', 'stored': stored, 'failed': failed}
+
+def prepare_mget(store, username, filenames):
+    """
+    Build the MGET response: one entry per file with its status and length, and the segments of
+    every file found, to be sent back to back in the order requested.
+    """
+    files, segments = [], []
+    try:
+        for filepath in filenames:
+            try:
+                response, file_segments = store.prepare_get(username, filepath)
+            except (IOError, ValueError) as e:
+                response, file_segments = {'status': 'ERROR', 'message': str(e)}, None
+            files.append({'filename': filepath, 'status': response['status'],
+                          'length': response.get('length', 0) if file_segments is not None else 0})
+            segments.extend(file_segments or ())
+    except Exception:
+        for source, offset, length in segments:
+            if hasattr(source, 'close'):
+                source.close()
+        raise
+    return {'status': 'OK', 'files': files, 'length': sum(entry['length'] for entry in files)}, segments
+
+def handle_mget(conn, store, request_id, username, filenames, timer):
+    with timer.phase('disk'):
+        response, segments = prepare_mget(store, username, filenames)
+    with timer.phase('send'):
+        reply(conn, request_id, response)
+        stats.add_bytes(response['length'])
+        timer.bytes_out = response['length']
+        send_segments(conn, segments)
+
+def handle_list(store, username, request=None):
+    """
+    One page of a user's files in name order: up to 'limit' names after 'cursor', optionally only
+    those starting with 'prefix'. The reply's 'cursor' is passed back to get the next page and is
+    None on the last one. With 'details' set the reply also maps each name to its size and mtime.
+    """
+    request = request or {}
+    names = store.list_files(username)
+    prefix = request.get('prefix', '')
+    limit = max(1, min(request.get('limit', LIST_PAGE_SIZE), LIST_PAGE_SIZE))
+    start = max(bisect.bisect_right(names, request.get('cursor') or ''), bisect.bisect_left(names, prefix))
+    page = []
+    for name in names[start:start + limit + 1]:
+        if not name.startswith(prefix):
             break
-        command, filepath, content,username = data.split('|', 3)
-        
-    
+        page.append(name)
+    more = len(page) > limit
+    page = page[:limit]
+    response = {'status': 'OK', 'files': page, 'cursor': page[-1] if more else None}
+    if request.get('details'):
+        response['details'] = store.file_details(username, page)
+    return response
 
-        try:
-            if command == 'PUT':
-                if not os.path.exists(f'content/{username}'):
-                    os.makedirs(f'content/{username}')
-                    
-                with open(f'content/{username}/{filepath}', 'w') as f:
-                    f.write(content)
-                    f.close()
-                response = 'PUT_COMPLETE'
-            elif command == 'GET':
-                
-                if not os.path.exists(f'content/{username}'):
-                    os.makedirs(f'content/{username}')
-         
-                with open(f'content/{username}/{filepath}', 'r') as f:
-                        response = f.read()
-                        
-                        if response == "":
-                            response = "FILE IS_EMPTY"
-                        f.close()
-            elif command == 'LIST':
-                
-                if not os.path.exists(f'content/{username}'):
-                    os.makedirs(f'content/{username}')
-                   
-                
-                files = os.listdir(f'content/{username}')
-                response = json.dumps(files)
-
-
-                
+def handle_has_blocks(store, request):
+    """ Tell a client which of the blocks of the file it is about to upload are not stored yet. """
+    return {'status': 'OK', 'missing': store.missing_blocks(request.get('blocks', []))}
+
+def handle_put_manifest(store, username, request):
+    """ Finish a deduplicated upload: every block has been sent, now point the file at them. """
+    store.write_manifest(username, request.get('filename', ''), request.get('blocks', []))
+    return {'status': 'PUT_COMPLETE'}
+
+def send_throttled(conn, segments, rate):
+    """ Like send_segments, but pausing between chunks so that no more than rate bytes/s are sent (no limit if rate is falsy). """
+    started = time.monotonic()
+    sent = 0
+    for source, offset, length in segments:
+        if isinstance(source, bytes):
+            source = nullcontext(source)
+        with (open(source, 'rb') if isinstance(source, str) else source) as f:
+            position = offset
+            while position < offset + length:
+                count = min(CHUNK_SIZE, offset + length - position)
+                if isinstance(f, bytes):
+                    conn.sendall(memoryview(f)[position:position + count])
+                else:
+                    send_file_range(conn, f, position, count)
+                position += count
+                sent += count
+                if rate:
+                    delay = sent / rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+def copy_to_peer(store, username, filepath, target, rate):
+    """ PUT one stored file to another storage server, compressed files as they are stored. """
+    host, port = target.rsplit(':', 1)
+    with no_delay(socket.create_connection((host, int(port)), timeout=PEER_TIMEOUT)) as conn:
+        response, segments = store.prepare_get(username, filepath, 0, None, store.codecs)
+        if response['status'] not in ('OK', 'FILE_IS_EMPTY'):
+            return response
+        request = {'op': 'PUT', 'filename': filepath, 'username': username, 'length': response['length']}
+        if 'codec' in response:
+            request.update(codec=response['codec'], size=response['size'])
+        if AUTH_SECRET is not None:
+            request['token'] = issue_token(AUTH_SECRET, username, PEER_TIMEOUT)
+        send_header(conn, request)
+        send_throttled(conn, segments or (), rate)
+        response = recv_header(conn)
+    if response is None:
+        raise ConnectionError(f"{target} closed the connection")
+    return response
+
+def replicate_file(store, username, filepath, target, rate=None, move=False, link=None):
+    """
+    Copy a file to the storage server at target ('host:port') at no more than rate bytes/s, for the
+    naming server's rebalancer. The peer reports the new copy to the naming server itself. A file that
+    changes while it is copied is copied again, so the peer does not end up with an outdated version.
+    With move set the local copy is then deleted, unless it changed once more.
+    """
+    for attempt in range(REPLICATE_ATTEMPTS):
+        before = store.file_details(username, [filepath])[filepath]
+        if before is None:
+            return {'status': 'FILE_NOT_FOUND'}
+        response = copy_to_peer(store, username, filepath, target, rate)
+        if response.get('status') != 'PUT_COMPLETE':
+            return {'status': 'ERROR', 'message': f"{target} did not store the copy: {response.get('message', response.get('status'))}"}
+        if store.file_details(username, [filepath])[filepath] == before:
+            break
+    else:
+        return {'status': 'ERROR', 'message': 'File kept changing while it was copied'}
+    deleted = move and delete_file(store, username, filepath, link)['status'] == 'DELETED'
+    return {'status': 'REPLICATED', 'deleted': deleted}
+
+def delete_file(store, username, filepath, link=None):
+    if not store.delete(username, filepath):
+        return {'status': 'FILE_NOT_FOUND'}
+    report_removed_file(link, username, filepath)
+    return {'status': 'DELETED'}
+
+def handle_stats(request):
+    """ This server's request metrics, as JSON or (with 'format': 'prometheus') as Prometheus text. """
+    if request.get('format') == 'prometheus':
+        return {'status': 'OK', 'text': metrics.render()}
+    return dict(metrics.snapshot(), status='OK')
+
+def handle_client(conn, base_directory, store, link=None, accepted=None):
+    """
+    Serve framed requests until the peer disconnects. Every request and response
+    starts with a length-prefixed JSON header ({'op', 'filename', 'username', 'length'});
+    a PUT request or a GET response is followed by exactly 'length' body bytes.
+    A GET may add 'offset' and 'count' to fetch only a byte range of the file.
+    CODECS lists the codecs a PUT body may be compressed with ('codec', plus the original
+    'size'); a GET naming codecs in 'accept' may get the file back still compressed.
+    When an auth secret is configured every request must carry a valid session 'token',
+    which also decides the user the request acts for.
+    MPUT and MGET move a batch of files ('files') in one request: the bodies follow the
+    request (MPUT) or the response (MGET) back to back. LIST returns one page of names.
+    Connections are persistent and requests may be pipelined; replies come back in
+    request order and echo the request's 'id'.
+    With the block store, HAS_BLOCKS, PUT_BLOCK and PUT_MANIFEST let a client upload
+    only the blocks of a file that the server does not already have.
+    DELETE removes a file. REPLICATE, sent by the naming server's rebalancer, copies a file
+    to the peer storage server 'target' at no more than 'rate' bytes/s, then deletes the
+    local copy if 'move' is set.
+    STATS returns the server's request metrics, and PROFILE starts, stops or reports on
+    the sampling profiler ('action').
+    """
+    if accepted is not None:
+        metrics.record_accept(time.perf_counter() - accepted)
+    stats.connection_opened()
+    try:
+        while True:
+            request = recv_header(conn)
+            if request is None:
+                break
+            command = request.get('op')
+            timer = metrics.start(command if command in COMMANDS else 'UNKNOWN')
+            try:
+                serve_request(conn, store, link, request, timer)
+            except Exception:
+                timer.failed = True
+                raise
+            finally:
+                timer.finish()
+    except (ConnectionError, OSError, ValueError) as e:
+        print(f"Connection error: {e}")
+    finally:
+        stats.connection_closed()
+        conn.close()
+
+def serve_request(conn, store, link, request, timer):
+    """ Serve one request of a connection handled by handle_client and send its reply. """
+    command = request.get('op')
+    filepath = request.get('filename', '')
+    username = authenticate(request)
+    length = request.get('length', 0)
+    request_id = request.get('id')
+    timer.bytes_in = length
+    if username is None:
+        discard_body(conn, length)
+        timer.failed = True
+        reply(conn, request_id, {'status': 'ERROR', 'message': 'Invalid or expired session token'})
+        return
+    if command in ('PUT', 'PUT_BLOCK'):
+        stats.add_bytes(length)
+
+    started = stats.request_started()
+    try:
+        if command == 'PUT':
+            response = handle_put(conn, store, filepath, username, length, timer, request.get('codec'), request.get('size'))
+            if response['status'] == 'PUT_COMPLETE':
+                report_stored_file(link, username, filepath)
+        elif command == 'GET':
+            handle_get(conn, store, request_id, filepath, username, timer, request.get('offset', 0), request.get('count'),
+                       request.get('accept', ()))
+            return
+        elif command == 'CODECS':
+            response = {'status': 'OK', 'codecs': list(store.codecs)}
+        elif command == 'LIST':
+            with timer.phase('disk'):
+                response = handle_list(store, username, request)
+        elif command == 'DELETE':
+            with timer.phase('disk'):
+                response = delete_file(store, username, filepath, link)
+        elif command == 'REPLICATE':
+            with timer.phase('send'):
+                response = replicate_file(store, username, filepath, request.get('target', ''), request.get('rate'),
+                                          request.get('move', False), link)
+        elif command == 'STATS':
+            response = handle_stats(request)
+        elif command == 'PROFILE':
+            response = dict(handle_profile(profiler, request), status='OK')
+        elif command in ('MPUT', 'MGET') and check_batch(request) is not None:
+            discard_body(conn, length)
+            response = {'status': 'ERROR', 'message': check_batch(request)}
+        elif command == 'MPUT':
+            response = handle_mput(conn, store, username, request['files'], link, timer)
+        elif command == 'MGET':
+            handle_mget(conn, store, request_id, username, request['files'], timer)
+            return
+        elif command in BLOCK_COMMANDS and hasattr(store, 'write_block'):
+            if command == 'HAS_BLOCKS':
+                with timer.phase('disk'):
+                    response = handle_has_blocks(store, request)
+            elif command == 'PUT_BLOCK':
+                if length > MAX_BLOCK_SIZE:
+                    discard_body(conn, length)
+                    response = {'status': 'ERROR', 'message': 'Block too large'}
+                else:
+                    with timer.phase('recv'):
+                        block = recv_exact(conn, length)
+                    if block is None:
+                        raise ConnectionError("Connection closed while receiving block")
+                    with timer.phase('disk'):
+                        store.write_block(request.get('block', ''), block)
+                    response = {'status': 'BLOCK_STORED'}
             else:
-                response = 'FILE_NOT_FOUND'
-        except IOError as e:
-            response = f"ERROR: {e.strerror}"
+                with timer.phase('disk'):
+                    response = handle_put_manifest(store, username, request)
+                report_stored_file(link, username, filepath)
+        else:
+            discard_body(conn, length)
+            response = {'status': 'FILE_NOT_FOUND'}
+    except ConnectionError:
+        raise
+    except IOError as e:
+        response = {'status': 'ERROR', 'message': e.strerror}
+    except ValueError as e:
+        response = {'status': 'ERROR', 'message': str(e)}
+    finally:
+        stats.request_finished(started)
+    timer.failed = response['status'] == 'ERROR'
+    with timer.phase('send'):
+        reply(conn, request_id, response)
+
+async def recv_header_async(reader):
+    """ Asyncio counterpart of recv_header. """
+    try:
+        prefix = await reader.readexactly(HEADER_PREFIX.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed while reading header")
+    (header_length,) = HEADER_PREFIX.unpack(prefix)
+    try:
+        payload = await reader.readexactly(header_length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed while reading header")
+    return json.loads(payload.decode())
+
+async def reply_async(writer, request_id, response):
+    if request_id is not None:
+        response['id'] = request_id
+    payload = json.dumps(response).encode()
+    writer.write(HEADER_PREFIX.pack(len(payload)) + payload)
+    # Wait for slow readers instead of buffering replies for them without bound
+    await writer.drain()
+
+async def discard_body_async(reader, length):
+    remaining = length
+    while remaining > 0:
+        data = await reader.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            raise ConnectionError("Connection closed while discarding body")
+        remaining -= len(data)
+
+async def handle_put_async(reader, executor, store, filepath, username, length, timer, codec=None, size=None):
+    """ Receive an upload on the event loop, handing every disk operation to the worker pool. """
+    loop = asyncio.get_running_loop()
+    if codec is not None and codec not in store.codecs:
+        await discard_body_async(reader, length)
+        return {'status': 'ERROR', 'message': f"Unsupported codec {codec}"}
+    try:
+        with timer.phase('disk'):
+            upload = await loop.run_in_executor(executor, store.begin_put, username, filepath, codec, size)
+    except IOError as e:
+        await discard_body_async(reader, length)
+        return {'status': 'ERROR', 'message': e.strerror}
+    except ValueError as e:
+        await discard_body_async(reader, length)
+        return {'status': 'ERROR', 'message': str(e)}
+    try:
+        remaining = length
+        while remaining > 0:
+            with timer.phase('recv'):
+                data = await reader.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise ConnectionError("Connection closed while receiving body")
+            with timer.phase('disk'):
+                await loop.run_in_executor(executor, upload.write, data)
+            remaining -= len(data)
+        with timer.phase('disk'):
+            await loop.run_in_executor(executor, upload.commit)
+    except Exception:
+        upload.abort()
+        raise
+    return {'status': 'PUT_COMPLETE'}
+
+async def handle_mput_async(reader, executor, store, username, files, link, timer):
+    stored, failed = [], {}
+    for entry in files:
+        filepath = entry.get('filename', '')
+        response = await handle_put_async(reader, executor, store, filepath, username, entry.get('length', 0), timer,
+                                          entry.get('codec'), entry.get('size'))
+        if response['status'] == 'PUT_COMPLETE':
+            stored.append(filepath)
+        else:
+            failed[filepath] = response.get('message')
+    report_stored_files(link, username, stored)
+    return {'status': 'ERROR' if failed else 'PUT_COMPLETE', 'stored': stored, 'failed': failed}
+
+async def send_segments_async(writer, executor, segments):
+    loop = asyncio.get_running_loop()
+    for source, offset, length in segments:
+        if isinstance(source, bytes):
+            writer.write(memoryview(source)[offset:offset + length])
+            await writer.drain()
+            continue
+        if isinstance(source, str):
+            source = await loop.run_in_executor(executor, open, source, 'rb')
+        with source:
+            # Uses os.sendfile on the socket, or reads through the worker pool where it can't
+            await loop.sendfile(writer.transport, source, offset, length)
+
+async def handle_client_async(reader, writer, limiter, executor, store, link=None):
+    """ Serve one connection on the event loop, speaking the same protocol as handle_client. """
+    waiting = time.perf_counter()
+    stats.connection_waiting()
+    async with limiter:
+        stats.connection_admitted()
+        metrics.record_accept(time.perf_counter() - waiting)
+        stats.connection_opened()
         try:
-            
-            conn.sendall(response.encode())
-        except:
-            pass
-    conn.close()
+            while True:
+                request = await recv_header_async(reader)
+                if request is None:
+                    break
+                command = request.get('op')
+                timer = metrics.start(command if command in COMMANDS else 'UNKNOWN')
+                try:
+                    await serve_request_async(reader, writer, executor, store, link, request, timer)
+                except Exception:
+                    timer.failed = True
+                    raise
+                finally:
+                    timer.finish()
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"Connection error: {e}")
+        finally:
+            stats.connection_closed()
+            writer.close()
+
+async def serve_request_async(reader, writer, executor, store, link, request, timer):
+    """ Asyncio counterpart of serve_request. """
+    loop = asyncio.get_running_loop()
+    command = request.get('op')
+    filepath = request.get('filename', '')
+    username = authenticate(request)
+    length = request.get('length', 0)
+    request_id = request.get('id')
+    timer.bytes_in = length
+    if username is None:
+        await discard_body_async(reader, length)
+        timer.failed = True
+        await reply_async(writer, request_id, {'status': 'ERROR', 'message': 'Invalid or expired session token'})
+        return
+    if command in ('PUT', 'PUT_BLOCK'):
+        stats.add_bytes(length)
 
-def register_with_naming_server(naming_server_host, naming_server_port, local_port):
+    started = stats.request_started()
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((naming_server_host, naming_server_port))
-            register_message = json.dumps({
-                'type': 'register',
-                'port': local_port  # Including local port information
-            })
-            s.sendall(register_message.encode())
-            response = json.loads(s.recv(1024).decode())
-            print("Registration response:", response)
+        if command == 'PUT':
+            response = await handle_put_async(reader, executor, store, filepath, username, length, timer,
+                                              request.get('codec'), request.get('size'))
+            if response['status'] == 'PUT_COMPLETE':
+                report_stored_file(link, username, filepath)
+        elif command == 'GET':
+            with timer.phase('disk'):
+                response, segments = await loop.run_in_executor(executor, store.prepare_get, username, filepath,
+                                                                request.get('offset', 0), request.get('count'),
+                                                                request.get('accept', ()))
+            with timer.phase('send'):
+                await reply_async(writer, request_id, response)
+                if segments is not None:
+                    stats.add_bytes(response['length'])
+                    timer.bytes_out = response['length']
+                    await send_segments_async(writer, executor, segments)
+            return
+        elif command == 'CODECS':
+            response = {'status': 'OK', 'codecs': list(store.codecs)}
+        elif command == 'LIST':
+            with timer.phase('disk'):
+                response = await loop.run_in_executor(executor, handle_list, store, username, request)
+        elif command == 'DELETE':
+            with timer.phase('disk'):
+                response = await loop.run_in_executor(executor, delete_file, store, username, filepath, link)
+        elif command == 'REPLICATE':
+            # A throttled copy holds one I/O worker for as long as it takes
+            with timer.phase('send'):
+                response = await loop.run_in_executor(executor, replicate_file, store, username, filepath,
+                                                      request.get('target', ''), request.get('rate'),
+                                                      request.get('move', False), link)
+        elif command == 'STATS':
+            response = handle_stats(request)
+        elif command == 'PROFILE':
+            # Stopping joins the sampling thread, which may take an interval
+            response = dict(await loop.run_in_executor(executor, handle_profile, profiler, request), status='OK')
+        elif command in ('MPUT', 'MGET') and check_batch(request) is not None:
+            await discard_body_async(reader, length)
+            response = {'status': 'ERROR', 'message': check_batch(request)}
+        elif command == 'MPUT':
+            response = await handle_mput_async(reader, executor, store, username, request['files'], link, timer)
+        elif command == 'MGET':
+            with timer.phase('disk'):
+                response, segments = await loop.run_in_executor(executor, prepare_mget, store, username,
+                                                                request['files'])
+            with timer.phase('send'):
+                await reply_async(writer, request_id, response)
+                stats.add_bytes(response['length'])
+                timer.bytes_out = response['length']
+                await send_segments_async(writer, executor, segments)
+            return
+        elif command in BLOCK_COMMANDS and hasattr(store, 'write_block'):
+            if command == 'HAS_BLOCKS':
+                with timer.phase('disk'):
+                    response = await loop.run_in_executor(executor, handle_has_blocks, store, request)
+            elif command == 'PUT_BLOCK':
+                if length > MAX_BLOCK_SIZE:
+                    await discard_body_async(reader, length)
+                    response = {'status': 'ERROR', 'message': 'Block too large'}
+                else:
+                    try:
+                        with timer.phase('recv'):
+                            block = await reader.readexactly(length)
+                    except asyncio.IncompleteReadError:
+                        raise ConnectionError("Connection closed while receiving block")
+                    with timer.phase('disk'):
+                        await loop.run_in_executor(executor, store.write_block, request.get('block', ''), block)
+                    response = {'status': 'BLOCK_STORED'}
+            else:
+                with timer.phase('disk'):
+                    response = await loop.run_in_executor(executor, handle_put_manifest, store, username, request)
+                report_stored_file(link, username, filepath)
+        else:
+            await discard_body_async(reader, length)
+            response = {'status': 'FILE_NOT_FOUND'}
+    except ConnectionError:
+        raise
+    except IOError as e:
+        response = {'status': 'ERROR', 'message': e.strerror}
+    except ValueError as e:
+        response = {'status': 'ERROR', 'message': str(e)}
+    finally:
+        stats.request_finished(started)
+    timer.failed = response['status'] == 'ERROR'
+    with timer.phase('send'):
+        await reply_async(writer, request_id, response)
+
+class ServerStats:
+    """ Load figures reported to the naming server with every heartbeat. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active_connections = 0
+        self.waiting_connections = 0
+        self.in_flight = 0
+        self.latency = None
+        self.bytes_transferred = 0
+        self.sampled_bytes = 0
+        self.sampled_at = time.monotonic()
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+    def connection_waiting(self):
+        """ A connection is queued behind the async server's connection limit. """
+        with self.lock:
+            self.waiting_connections += 1
+
+    def connection_admitted(self):
+        with self.lock:
+            self.waiting_connections -= 1
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.monotonic()
+
+    def request_finished(self, started):
+        """ Fold the time a request took into the moving-average latency. """
+        seconds = time.monotonic() - started
+        with self.lock:
+            self.in_flight -= 1
+            self.latency = seconds if self.latency is None else (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * seconds
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes_transferred += count
+
+    def levels(self):
+        """ Current connection and request levels, exported with the metrics without touching the throughput sample. """
+        with self.lock:
+            return {'active_connections': self.active_connections, 'in_flight': self.in_flight,
+                    'queue_depth': self.waiting_connections, 'latency_ms': round((self.latency or 0.0) * 1000, 3),
+                    'bytes_transferred': self.bytes_transferred}
+
+    def snapshot(self):
+        """ Current load, with throughput averaged since the previous snapshot. """
+        with self.lock:
+            now = time.monotonic()
+            bytes_per_second = (self.bytes_transferred - self.sampled_bytes) / max(now - self.sampled_at, 1e-6)
+            self.sampled_bytes = self.bytes_transferred
+            self.sampled_at = now
+            active_connections = self.active_connections
+            in_flight = self.in_flight
+            queue_depth = self.waiting_connections
+            latency = self.latency or 0.0
+        disk = shutil.disk_usage('.')
+        return {
+            'free_disk': disk.free,
+            'total_disk': disk.total,
+            'active_connections': active_connections,
+            'in_flight': in_flight,
+            'queue_depth': queue_depth,
+            'latency_ms': round(latency * 1000, 3),
+            'bytes_per_second': round(bytes_per_second),
+        }
+
+stats = ServerStats()
+metrics = Metrics('dfs_storage', stats.levels)
+profiler = SamplingProfiler()
+
+def store_gauges(store):
+    """ Levels exported with the metrics: the server's load and, with the cache on, its counters. """
+    levels = stats.levels()
+    if isinstance(store, CachedStore):
+        levels.update({f'cache_{name}': value for name, value in store.counters().items()})
+    return levels
+
+class NamingServerLink:
+    """ A persistent connection to the naming server, reopened transparently when it drops. """
+
+    def __init__(self, host, port, local_port):
+        self.address = (host, port)
+        self.local_port = local_port
+        self.sock = None
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.reports = queue.Queue()  # (username, filepath, removed) waiting for send_reports
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def request(self, message):
+        """ Send one message and wait for its reply, reconnecting once if the connection went stale. """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = no_delay(socket.create_connection(self.address))
+                    self.next_id += 1
+                    send_header(self.sock, dict(message, id=self.next_id))
+                    response = recv_header(self.sock)
+                    if response is None:
+                        raise ConnectionError("Naming server closed the connection")
+                    return response
+                except OSError:
+                    self.close()
+                    if attempt:
+                        raise
+
+def register_with_naming_server(link, local_port, store):
+    try:
+        response = link.request({
+            'type': 'register',
+            'port': local_port,  # Including local port information
+            'files': store.stored_files()
+        })
+        print("Registration response:", response)
     except Exception as e:
         print(f"Failed to register with naming server: {e}")
 
-def send_heartbeat(naming_server_host, naming_server_port, local_port):
+def report_stored_file(link, username, filepath):
+    """ Tell the naming server that this server now holds a file, so queries can find it. """
+    report_stored_files(link, username, [filepath])
+
+def report_stored_files(link, username, filepaths, removed=False):
+    """ Queue stored (or, with removed set, deleted) files to be reported by send_reports; never waits for the naming server. """
+    if link is None:
+        return
+    for filepath in filepaths:
+        link.reports.put((username, filepath, removed))
+
+def report_removed_file(link, username, filepath):
+    """ Tell the naming server that this server no longer holds a file. """
+    report_stored_files(link, username, [filepath], removed=True)
+
+def send_reports(link):
+    """
+    Report stored and removed files to the naming server in the background, so replies to clients never
+    wait on it. Everything queued while the previous update was in flight goes out together: one update
+    per run of files of the same user and kind, in the order they were queued.
+    """
+    while True:
+        pending = [link.reports.get()]
+        while len(pending) < REPORT_BATCH_FILES:
+            try:
+                pending.append(link.reports.get_nowait())
+            except queue.Empty:
+                break
+        for (username, removed), group in itertools.groupby(pending, key=lambda report: (report[0], report[2])):
+            filepaths = [filepath for _, filepath, _ in group]
+            message = {'type': 'update', 'port': link.local_port, 'username': username, 'filenames': filepaths}
+            if removed:
+                message['removed'] = True
+            try:
+                link.request(message)
+            except Exception as e:
+                print(f"Failed to report {len(filepaths)} files of {username} to naming server: {e}")
+
+def send_heartbeat(link, local_port, store, interval=HEARTBEAT_INTERVAL):
+    """ Push a heartbeat carrying this server's load figures every interval seconds. """
     while True:
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((naming_server_host, naming_server_port))
-                heartbeat_message = json.dumps({
-                    'type': 'heartbeat',
-                    'port': local_port  # Including local port information
-                })
-                s.sendall(heartbeat_message.encode())
-                response = s.recv(1024).decode()
+            load = stats.snapshot()
+            if isinstance(store, CachedStore):
+                load['cache'] = store.counters()
+            response = link.request({
+                'type': 'heartbeat',
+                'port': local_port,  # Including local port information
+                'stats': load
+            })
+            if response.get('status') != 'heartbeat acknowledged':
                 print("Heartbeat response:", response)
+                # The naming server lost track of us (e.g. it restarted), so register again
+                register_with_naming_server(link, local_port, store)
         except Exception as e:
             print(f"Failed to send heartbeat: {e}")
-        time.sleep(5)  # send a heartbeat every 5 seconds
+        time.sleep(interval)
 
-def start_server(local_host, local_port, naming_server_host, naming_server_port, storage_directory):
+def collect_blocks(store, interval=GC_INTERVAL):
+    """ Delete the blocks no manifest refers to every interval seconds. """
+    while True:
+        time.sleep(interval)
+        try:
+            deleted = store.collect_garbage()
+        except Exception as e:
+            print(f"Failed to collect unreferenced blocks: {e}")
+            continue
+        if deleted:
+            print(f"Deleted {deleted} unreferenced blocks")
+
+def start_background_tasks(link, local_port, store, heartbeat_interval, gc_interval):
+    """ Start the heartbeat, the naming server reporter and, for the block store, the block collector. """
+    threading.Thread(target=send_heartbeat, args=(link, local_port, store, heartbeat_interval), daemon=True).start()
+    threading.Thread(target=send_reports, args=(link,), daemon=True).start()
+    if gc_interval > 0 and hasattr(store, 'collect_garbage'):
+        threading.Thread(target=collect_blocks, args=(store, gc_interval), daemon=True).start()
+
+def create_store(backend, cache_size=CACHE_SIZE):
+    store = BlockStore() if backend == 'blocks' else FileStore()
+    store = CachedStore(store, cache_size) if cache_size > 0 else store
+    metrics.gauges = lambda: store_gauges(store)
+    return store
+
+def listen(local_host, local_port, backlog=128):
+    """
+    Bind and listen on the server's port. This happens before registering, so the naming server never
+    lists a server that cannot accept connections.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Persistent connections of a previous run may still hold the port in TIME_WAIT
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((local_host, local_port))
+    s.listen(backlog)
+    return s
+
+def start_server(local_host, local_port, naming_server_host, naming_server_port, storage_directory, backend='files',
+                 heartbeat_interval=HEARTBEAT_INTERVAL, cache_size=CACHE_SIZE, gc_interval=GC_INTERVAL):
     if not os.path.exists(storage_directory):
         os.makedirs(storage_directory)
 
-    register_with_naming_server(naming_server_host, naming_server_port, local_port)
-    heartbeat_thread = threading.Thread(target=send_heartbeat, args=(naming_server_host, naming_server_port, local_port))
-    heartbeat_thread.start()
+    store = create_store(backend, cache_size)
+    s = listen(local_host, local_port)
+    link = NamingServerLink(naming_server_host, naming_server_port, local_port)
+    register_with_naming_server(link, local_port, store)
+    start_background_tasks(link, local_port, store, heartbeat_interval, gc_interval)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((local_host, local_port))
-        s.listen()
+    with s:
         print(f"Storage Server listening on {local_host}:{local_port}")
         while True:
             conn, addr = s.accept()
+            accepted = time.perf_counter()
             print(f"Connected by {addr}")
-            thread = threading.Thread(target=handle_client, args=(conn, storage_directory))
+            no_delay(conn)  # asyncio sets this itself in async mode
+            thread = threading.Thread(target=handle_client, args=(conn, storage_directory, store, link, accepted))
             thread.start()
 
+async def serve_async(local_host, local_port, sock, store, link, max_connections, io_workers):
+    limiter = asyncio.Semaphore(max_connections)
+    executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='storage-io')
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client_async(reader, writer, limiter, executor, store, link),
+        sock=sock, backlog=1024)
+    print(f"Storage Server (asyncio) listening on {local_host}:{local_port}")
+    async with server:
+        await server.serve_forever()
+
+def start_async_server(local_host, local_port, naming_server_host, naming_server_port, storage_directory,
+                       max_connections=MAX_CONNECTIONS, io_workers=IO_WORKERS, backend='files',
+                       heartbeat_interval=HEARTBEAT_INTERVAL, cache_size=CACHE_SIZE, gc_interval=GC_INTERVAL):
+    """
+    Serve every connection from one asyncio event loop. At most max_connections are served at
+    once and blocking file I/O runs on a pool of io_workers threads.
+    """
+    if not os.path.exists(storage_directory):
+        os.makedirs(storage_directory)
+
+    store = create_store(backend, cache_size)
+    sock = listen(local_host, local_port, backlog=1024)
+    link = NamingServerLink(naming_server_host, naming_server_port, local_port)
+    register_with_naming_server(link, local_port, store)
+    start_background_tasks(link, local_port, store, heartbeat_interval, gc_interval)
+
+    asyncio.run(serve_async(local_host, local_port, sock, store, link, max_connections, io_workers))
+
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Usage: python storage_server.py [local_host] [local_port] [naming_server_host] [naming_server_port]")
-        sys.exit(1)
-
-    local_host = sys.argv[1]
-    local_port = int(sys.argv[2])
-    naming_server_host = sys.argv[3]
-    naming_server_port = int(sys.argv[4])
+    parser = argparse.ArgumentParser(description="Storage server for the distributed file system")
+    parser.add_argument('local_host')
+    parser.add_argument('local_port', type=int)
+    parser.add_argument('naming_server_host')
+    parser.add_argument('naming_server_port', type=int)
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="serve each connection on its own thread, or all of them on one asyncio event loop")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="connections served at once in async mode; further connections wait")
+    parser.add_argument('--io-workers', type=int, default=IO_WORKERS,
+                        help="threads used for blocking file I/O in async mode")
+    parser.add_argument('--backend', choices=['files', 'blocks'], default='files',
+                        help="store whole files per user, or deduplicated content-addressed blocks")
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds between heartbeats to the naming server (may be below 1)")
+    parser.add_argument('--gc-interval', type=float, default=GC_INTERVAL,
+                        help="seconds between sweeps deleting blocks no file uses any more (block store); 0 disables them")
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help="bytes of small hot files and listings cached in memory; 0 disables the cache")
+    parser.add_argument('--auth-secret', default=AUTH_SECRET,
+                        help="secret the naming server signs session tokens with (default: $DFS_AUTH_SECRET); "
+                             "without one, requests are trusted to name their user")
+    parser.add_argument('--metrics-port', type=int,
+                        help="also serve the request metrics in Prometheus text format over HTTP on this port")
+    args = parser.parse_args()
+    AUTH_SECRET = args.auth_secret
+    if args.metrics_port:
+        serve_metrics(args.local_host, args.metrics_port, metrics)
+
     storage_directory = "/content"
-    start_server(local_host, local_port, naming_server_host, naming_server_port, storage_directory)
+    if args.mode == 'async':
+        start_async_server(args.local_host, args.local_port, args.naming_server_host, args.naming_server_port,
+                           storage_directory, args.max_connections, args.io_workers, args.backend,
+                           args.heartbeat_interval, args.cache_size, args.gc_interval)
+    else:
+        start_server(args.local_host, args.local_port, args.naming_server_host, args.naming_server_port,
+                     storage_directory, args.backend, args.heartbeat_interval, args.cache_size, args.gc_interval)
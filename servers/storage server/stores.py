@@ -0,0 +1,415 @@
+"""
+Storage backends for the storage server.
+
+Two backends share one interface, so the request handlers never need to know which one is in use:
+- FileStore keeps every upload as a whole file under content/<username>/<filename>.
+- BlockStore splits uploads into fixed-size blocks stored once under content/.blocks/, named by the SHA-256
+  of their contents, and keeps a per-user manifest listing each file's blocks under content/.manifests/.
+  Identical content uploaded by different users, or unchanged blocks of an edited file, are stored once,
+  and clients can ask which blocks are missing so they only send those. Blocks no manifest refers to any more
+  are removed by collect_garbage.
+
+Each backend provides:
+- begin_put(username, filepath, codec, size): an upload object with write(data), commit() and abort(). The data is
+  compressed with codec when one is given; codecs lists the codecs a backend can store as they arrive.
+- prepare_get(username, filepath, offset, count, accept): the response header and the segments to send, as a list of
+  (open file or path, offset, length) tuples, or None when no body follows. A file stored compressed with a codec
+  in accept is sent as it is stored, with the codec named in the response.
+- list_files(username), sorted by name, and file_details(username, names), the size and modification time of some of
+  them, for LIST; stored_files() for naming server registration.
+- delete(username, filepath): remove a file, returning whether it existed.
+
+Usernames and filenames are single path components: a backend raises ValueError for a name that is empty,
+'.' or '..', or that contains a path separator, rather than touch anything outside the user's directory.
+"""
+
+
+import hashlib
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from compressors import CODECS, MAGIC, blob_header, decompress_file, read_blob_header
+
+BLOCK_SIZE = 1024 * 1024  # bytes per block in the block store
+MAX_BLOCK_SIZE = 4 * BLOCK_SIZE  # largest block a client may send
+BLOCK_GRACE = 3600.0  # seconds an unreferenced block is kept after it was last written or found present
+DIGEST = re.compile(r'[0-9a-f]{64}')  # block names: hex SHA-256 digests
+
+# Numbers the temporary files of uploads, so concurrent uploads of one file never share one
+upload_ids = itertools.count()
+
+def check_name(name):
+    """ Return name if it is safe as one path component (a username or filename); raise ValueError otherwise. """
+    if not isinstance(name, str) or name in ('', '.', '..') or any(c in name for c in '/\\\0'):
+        raise ValueError(f"Invalid name {name!r}")
+    return name
+
+def listed_name(name):
+    """
+    The name LIST shows for a stored object, or None to hide it. Hidden objects start with a dot;
+    the first stripe of a striped file ('.<filename>.stripe0') stands for the whole file.
+    """
+    if not name.startswith('.'):
+        return name
+    if name.endswith('.stripe0'):
+        return name[1:-len('.stripe0')]
+    return None
+
+def range_response(size, offset=0, count=None):
+    """ Build the GET response header for the byte range [offset, offset + count) of a file of the given size. """
+    if size == 0:
+        return {'status': 'FILE_IS_EMPTY', 'length': 0, 'size': 0}
+    if offset < 0 or offset > size or (count is not None and count < 0):
+        return {'status': 'ERROR', 'message': 'Invalid byte range'}
+    length = size - offset if count is None else min(count, size - offset)
+    return {'status': 'OK', 'length': length, 'offset': offset, 'size': size}
+
+def atomic_write(path, data):
+    """ Write data so that readers only ever see the complete file. """
+    temp_path = f'{path}.{threading.get_ident()}.part'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def striped_name(name):
+    """ The object the first stripe of a striped file is stored as. """
+    return f'.{name}.stripe0'
+
+def stat_details(path):
+    """ Size and modification time of a stored file, or None if it does not exist. """
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {'size': status.st_size, 'mtime': status.st_mtime}
+
+def block_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+class FileUpload:
+    """
+    Streams an upload into a hidden temporary file of its own and renames it into place on commit, so of
+    concurrent uploads of one file the last to commit wins and none of them is mixed with another. A compressed
+    upload is stored behind a header naming its codec; a plain one is stored as it is, unless it starts
+    like such a header, so its first bytes are held back until that is known.
+    """
+
+    def __init__(self, temp_path, final_path, codec=None, size=None):
+        self.temp_path = temp_path
+        self.final_path = final_path
+        self.f = open(temp_path, 'wb')
+        self.pending = None
+        if codec is None:
+            self.pending = bytearray()
+        else:
+            self.f.write(blob_header(codec, size))
+
+    def write(self, data):
+        if self.pending is None:
+            self.f.write(data)
+            return
+        self.pending += data
+        if len(self.pending) >= len(MAGIC):
+            self.write_pending()
+
+    def write_pending(self):
+        if self.pending.startswith(MAGIC):
+            self.f.write(blob_header('identity'))
+        self.f.write(self.pending)
+        self.pending = None
+
+    def commit(self):
+        if self.pending is not None:
+            self.write_pending()
+        self.f.close()
+        os.replace(self.temp_path, self.final_path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.temp_path)
+
+class FileStore:
+    """ Stores each upload as a whole file under content/<username>/, compressed if it arrived compressed. """
+
+    codecs = tuple(CODECS)
+
+    def __init__(self, root='content'):
+        self.root = root
+
+    def user_directory(self, username):
+        directory = f'{self.root}/{check_name(username)}'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return directory
+
+    def file_path(self, username, filepath):
+        return f'{self.user_directory(username)}/{check_name(filepath)}'
+
+    def begin_put(self, username, filepath, codec=None, size=None):
+        path = self.file_path(username, filepath)
+        return FileUpload(f'{os.path.dirname(path)}/.{filepath}.{next(upload_ids)}.part', path, codec, size)
+
+    def prepare_get(self, username, filepath, offset=0, count=None, accept=()):
+        path = self.file_path(username, filepath)
+        if not os.path.isfile(path):
+            return {'status': 'FILE_NOT_FOUND'}, None
+        # Send from the file we measured, even if a PUT replaces the path meanwhile
+        f = open(path, 'rb')
+        codec, size, data_offset = read_blob_header(f)
+        stored_length = os.fstat(f.fileno()).st_size - data_offset
+        if codec is None:
+            response = range_response(stored_length, offset, count)
+        elif codec in accept and offset == 0 and count is None:
+            response = {'status': 'OK', 'length': stored_length, 'offset': 0, 'size': size, 'codec': codec}
+            return response, [(f, data_offset, stored_length)]
+        else:
+            response = range_response(size, offset, count)
+        if response['status'] != 'OK':
+            f.close()
+            return response, None
+        if codec is None:
+            return response, [(f, data_offset + offset, response['length'])]
+        # The client cannot decode this file (or wants a range of it), so decompress it first
+        decoded = tempfile.TemporaryFile()
+        with f:
+            decompress_file(f, codec, decoded)
+        return response, [(decoded, offset, response['length'])]
+
+    def list_files(self, username):
+        names = (listed_name(name) for name in os.listdir(self.user_directory(username)))
+        return sorted(name for name in names if name is not None)
+
+    def stored_details(self, path):
+        """ Like stat_details, but reporting the original size of a file stored compressed. """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        with f:
+            codec, size, data_offset = read_blob_header(f)
+            status = os.fstat(f.fileno())
+        return {'size': status.st_size - data_offset if size is None else size, 'mtime': status.st_mtime}
+
+    def file_details(self, username, names):
+        details = {}
+        for name in names:
+            details[name] = self.stored_details(self.file_path(username, name))
+            if details[name] is None:
+                # Only the first stripe of a striped file is here, so its full size is unknown
+                details[name] = self.stored_details(self.file_path(username, striped_name(name)))
+                if details[name] is not None:
+                    details[name]['size'] = None
+        return details
+
+    def delete(self, username, filepath):
+        try:
+            os.remove(self.file_path(username, filepath))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stored_files(self):
+        if not os.path.isdir(self.root):
+            return []
+        # Report every stored object, stripes included, but not uploads still in progress
+        return [f'{username}/{filename}'
+                for username in os.listdir(self.root)
+                if not username.startswith('.') and os.path.isdir(f'{self.root}/{username}')
+                for filename in os.listdir(f'{self.root}/{username}')
+                if not (filename.startswith('.') and filename.endswith('.part'))]
+
+class BlockUpload:
+    """ Cuts an incoming stream into blocks as it arrives and records them in a manifest on commit. """
+
+    def __init__(self, store, username, filepath):
+        self.store = store
+        self.username = username
+        self.filepath = filepath
+        self.buffer = bytearray()
+        self.blocks = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self.store_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def store_block(self, block):
+        digest = block_digest(block)
+        self.store.write_block(digest, block)
+        self.blocks.append([digest, len(block)])
+
+    def commit(self):
+        if self.buffer:
+            self.store_block(bytes(self.buffer))
+            self.buffer.clear()
+        self.store.write_manifest(self.username, self.filepath, self.blocks)
+
+    def abort(self):
+        # Blocks already written are only reachable through a manifest, and collected once unreferenced
+        self.buffer.clear()
+
+class BlockStore:
+    """
+    Stores uploads as deduplicated, content-addressed blocks plus per-user manifests. Blocks are not
+    reference-counted; collect_garbage periodically deletes the ones no manifest lists (mark and sweep).
+    """
+
+    codecs = ()  # blocks are stored uncompressed so identical content still deduplicates
+
+    def __init__(self, root='content'):
+        self.block_root = f'{root}/.blocks'
+        self.manifest_root = f'{root}/.manifests'
+        # Held while a manifest is checked and written, and while a block is swept, so a block that a
+        # new manifest has just been checked against is never deleted before the manifest lands
+        self.lock = threading.Lock()
+
+    def block_path(self, digest):
+        if not isinstance(digest, str) or not DIGEST.fullmatch(digest):
+            raise ValueError(f"Invalid block digest {digest!r}")
+        return f'{self.block_root}/{digest[:2]}/{digest}'
+
+    def touch_block(self, digest):
+        """
+        Mark a stored block as just used, so garbage collection leaves it alone while an upload that
+        relies on it finishes. Returns whether the block is stored.
+        """
+        try:
+            os.utime(self.block_path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def missing_blocks(self, digests):
+        """ Return the digests, without duplicates, of blocks not stored yet. """
+        return [digest for digest in dict.fromkeys(digests) if not self.touch_block(digest)]
+
+    def write_block(self, digest, data):
+        """ Store a block under its digest; blocks whose contents do not match the digest are rejected. """
+        if block_digest(data) != digest:
+            raise ValueError(f"Block contents do not match digest {digest}")
+        if self.touch_block(digest):
+            return
+        os.makedirs(os.path.dirname(self.block_path(digest)), exist_ok=True)
+        atomic_write(self.block_path(digest), data)
+
+    def manifest_path(self, username, filepath):
+        return f'{self.manifest_root}/{check_name(username)}/{check_name(filepath)}.json'
+
+    def write_manifest(self, username, filepath, blocks):
+        """ Point a file at a list of [digest, size] blocks, all of which must already be stored. """
+        with self.lock:
+            missing = self.missing_blocks(digest for digest, size in blocks)
+            if missing:
+                raise ValueError(f"{len(missing)} blocks of the manifest are not stored")
+            os.makedirs(os.path.dirname(self.manifest_path(username, filepath)), exist_ok=True)
+            manifest = {'size': sum(size for digest, size in blocks), 'blocks': blocks}
+            atomic_write(self.manifest_path(username, filepath), json.dumps(manifest).encode())
+
+    def read_manifest(self, username, filepath):
+        try:
+            with open(self.manifest_path(username, filepath), 'rb') as f:
+                return json.loads(f.read().decode())
+        except FileNotFoundError:
+            return None
+
+    def begin_put(self, username, filepath, codec=None, size=None):
+        self.manifest_path(username, filepath)  # reject a bad name before the body arrives
+        return BlockUpload(self, username, filepath)
+
+    def prepare_get(self, username, filepath, offset=0, count=None, accept=()):
+        manifest = self.read_manifest(username, filepath)
+        if manifest is None:
+            return {'status': 'FILE_NOT_FOUND'}, None
+        response = range_response(manifest['size'], offset, count)
+        if response['status'] != 'OK':
+            return response, None
+        # Walk the blocks, keeping the parts that overlap the requested range
+        segments = []
+        start, end = offset, offset + response['length']
+        position = 0
+        for digest, size in manifest['blocks']:
+            if position + size > start and position < end:
+                segment_start = max(start, position)
+                segment_end = min(end, position + size)
+                segments.append((self.block_path(digest), segment_start - position, segment_end - segment_start))
+            position += size
+        return response, segments
+
+    def list_files(self, username):
+        directory = f'{self.manifest_root}/{check_name(username)}'
+        if not os.path.isdir(directory):
+            return []
+        names = (listed_name(name[:-len('.json')]) for name in os.listdir(directory) if name.endswith('.json'))
+        return sorted(name for name in names if name is not None)
+
+    def file_details(self, username, names):
+        details = {}
+        for name in names:
+            manifest = self.read_manifest(username, name)
+            status = stat_details(self.manifest_path(username, name))
+            if manifest is None:
+                manifest = self.read_manifest(username, striped_name(name))
+                status = stat_details(self.manifest_path(username, striped_name(name)))
+                if manifest is not None:
+                    manifest['size'] = None
+            details[name] = None if manifest is None or status is None else {'size': manifest['size'], 'mtime': status['mtime']}
+        return details
+
+    def delete(self, username, filepath):
+        """ Remove a file's manifest. Its blocks stay until collect_garbage finds no other file shares them. """
+        try:
+            os.remove(self.manifest_path(username, filepath))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stored_files(self):
+        if not os.path.isdir(self.manifest_root):
+            return []
+        return [f'{username}/{filename[:-len(".json")]}'
+                for username in os.listdir(self.manifest_root)
+                for filename in os.listdir(f'{self.manifest_root}/{username}') if filename.endswith('.json')]
+
+    def referenced_blocks(self):
+        """ The digests of every block some manifest lists. """
+        referenced = set()
+        if not os.path.isdir(self.manifest_root):
+            return referenced
+        for username in os.listdir(self.manifest_root):
+            for filename in os.listdir(f'{self.manifest_root}/{username}'):
+                if filename.endswith('.json'):
+                    manifest = self.read_manifest(username, filename[:-len('.json')])
+                    if manifest is not None:
+                        referenced.update(digest for digest, size in manifest['blocks'])
+        return referenced
+
+    def collect_garbage(self, grace=BLOCK_GRACE):
+        """
+        Delete the blocks no manifest lists, and leftovers of interrupted block writes. Blocks written or
+        found present in the last grace seconds are kept, since an upload may be about to list them in a
+        manifest. Returns the number of files deleted.
+        """
+        referenced = self.referenced_blocks()
+        if not os.path.isdir(self.block_root):
+            return 0
+        deleted = 0
+        for prefix in os.listdir(self.block_root):
+            for name in os.listdir(f'{self.block_root}/{prefix}'):
+                if name in referenced:
+                    continue
+                path = f'{self.block_root}/{prefix}/{name}'
+                with self.lock:
+                    try:
+                        if time.time() - os.stat(path).st_mtime < grace:
+                            continue
+                        os.remove(path)
+                    except FileNotFoundError:
+                        continue
+                deleted += 1
+        return deleted
@@ -0,0 +1,13 @@
+"""
+The servers are scripts run from their own directories rather than an installed package, so the tests
+import their modules the same way: from the directories the scripts put on sys.path.
+"""
+
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for directory in ('servers', 'servers/common', 'servers/storage server'):
+    sys.path.insert(0, os.path.join(ROOT, directory))
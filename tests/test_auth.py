@@ -0,0 +1,53 @@
+""" Session tokens, and the naming server's logins that issue them. """
+
+
+import hashlib
+import sqlite3
+
+import pytest
+
+from auth import issue_token, verify_token
+
+SECRET = 's3cret'
+
+def test_valid_token_names_its_user():
+    assert verify_token(SECRET, issue_token(SECRET, 'alice', 60)) == 'alice'
+
+def test_token_signed_with_another_secret_is_rejected():
+    assert verify_token(SECRET, issue_token('other', 'alice', 60)) is None
+
+def test_tampered_token_is_rejected():
+    username, expiry, signature = issue_token(SECRET, 'alice', 60).rsplit(':', 2)
+    assert verify_token(SECRET, f'bob:{expiry}:{signature}') is None
+    assert verify_token(SECRET, f'{username}:{int(expiry) + 3600}:{signature}') is None
+
+def test_expired_token_is_rejected():
+    assert verify_token(SECRET, issue_token(SECRET, 'alice', -1)) is None
+
+@pytest.mark.parametrize('token', [None, '', 'alice', 'alice:soon', 'alice:soon:deadbeef', 42])
+def test_malformed_token_is_rejected(token):
+    assert verify_token(SECRET, token) is None
+
+@pytest.fixture
+def naming_server(tmp_path, monkeypatch):
+    import server
+    database = str(tmp_path / 'users.db')
+    connection = sqlite3.connect(database)
+    connection.execute("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT)")
+    connection.execute("INSERT INTO users VALUES (?, ?)", ('alice', hashlib.sha256(b'wonderland').hexdigest()))
+    connection.commit()
+    connection.close()
+    monkeypatch.setattr(server, 'USERS_DATABASE', database)
+    monkeypatch.setattr(server, 'AUTH_SECRET', SECRET)
+    return server
+
+def test_login_issues_a_token_for_the_user(naming_server):
+    response = naming_server.handle_login({'type': 'login', 'username': 'alice', 'password': 'wonderland'})
+    assert response['status'] == 'logged in'
+    assert verify_token(SECRET, response['token']) == 'alice'
+
+@pytest.mark.parametrize('username, password', [('alice', 'wrong'), ('bob', 'wonderland'), ('alice', None)])
+def test_login_refuses_bad_credentials(naming_server, username, password):
+    response = naming_server.handle_login({'type': 'login', 'username': username, 'password': password})
+    assert response['status'] == 'error'
+    assert 'token' not in response
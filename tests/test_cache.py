@@ -0,0 +1,52 @@
+""" The storage server's cache never keeps a file older than the last completed upload. """
+
+
+import cache
+from cache import CachedStore
+from stores import FileStore
+
+KEY = ('file', 'user', 'a.txt')
+
+def cached_store(tmp_path):
+    return CachedStore(FileStore(str(tmp_path / 'content')))
+
+def put(store, filepath, data):
+    upload = store.begin_put('user', filepath)
+    upload.write(data)
+    upload.commit()
+
+def get(store, filepath):
+    response, segments = store.prepare_get('user', filepath)
+    return b''.join(bytes(data[offset:offset + length]) for data, offset, length in segments)
+
+def test_fill_racing_an_invalidation_is_discarded(tmp_path):
+    store = cached_store(tmp_path)
+    value, generation = store.lookup(KEY)
+    assert value is None
+    store.invalidate('user', 'a.txt')  # an upload commits while the fill reads the old file
+    store.insert(KEY, b'old', 3, generation)
+    assert store.lookup(KEY)[0] is None
+
+def test_invalidating_another_file_keeps_the_fill(tmp_path):
+    store = cached_store(tmp_path)
+    value, generation = store.lookup(KEY)
+    store.invalidate('user', 'b.txt')
+    store.insert(KEY, b'current', 7, generation)
+    assert store.lookup(KEY)[0] == b'current'
+
+def test_fill_older_than_forgotten_invalidations_is_discarded(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'RECENT_INVALIDATIONS', 2)
+    store = cached_store(tmp_path)
+    value, generation = store.lookup(KEY)
+    store.invalidate('user', 'a.txt')
+    store.invalidate('user', 'b.txt')  # pushes the invalidation of a.txt out of the record
+    store.insert(KEY, b'old', 3, generation)
+    assert store.lookup(KEY)[0] is None
+
+def test_upload_replaces_the_cached_copy(tmp_path):
+    store = cached_store(tmp_path)
+    put(store, 'a.txt', b'first')
+    assert get(store, 'a.txt') == b'first'
+    assert store.lookup(KEY)[0] == b'first'
+    put(store, 'a.txt', b'second')
+    assert get(store, 'a.txt') == b'second'
@@ -0,0 +1,62 @@
+""" Recovery of the naming server's metadata from its snapshot and write-ahead log. """
+
+
+from metadata_store import MetadataStore
+
+LAYOUT = {'size': 10, 'stripe_size': 4, 'stripes': [['s1'], ['s2'], ['s1']]}
+
+def recovered(directory, **options):
+    store = MetadataStore(**options)
+    store.open(str(directory))
+    return store
+
+def test_torn_tail_is_dropped_and_truncated(tmp_path):
+    store = recovered(tmp_path)
+    store.register_server('s1', ['u/a'])
+    store.record_file('s1', 'u/b')
+    with open(tmp_path / 'wal.log', 'a') as log:
+        log.write('{"op": "store", "server": "s1", "ke')  # a write cut short by a crash
+
+    store = recovered(tmp_path)
+    assert store.file_locations == {'u/a': {'s1'}, 'u/b': {'s1'}}
+    # The torn tail is cut off, so an entry committed after recovery is replayed too
+    store.record_file('s1', 'u/c')
+    assert recovered(tmp_path).file_locations == {'u/a': {'s1'}, 'u/b': {'s1'}, 'u/c': {'s1'}}
+
+def test_entry_without_newline_is_not_replayed(tmp_path):
+    store = recovered(tmp_path)
+    store.register_server('s1', [])
+    with open(tmp_path / 'wal.log', 'a') as log:
+        log.write('{"op": "store", "server": "s1", "key": "u/a"}')
+
+    assert recovered(tmp_path).file_locations == {}
+
+def test_snapshot_and_log_recover_the_same_state(tmp_path):
+    store = recovered(tmp_path, snapshot_every=4)
+    store.register_server('s1', ['u/a'])
+    store.register_server('s2', ['u/a', 'u/b'])
+    store.record_file('s1', 'u/c')
+    store.record_layout('u/d', LAYOUT)  # fourth entry: snapshot taken, log started afresh
+    store.drop_file('s2', 'u/a')
+    store.record_file('s2', 'u/d')  # a whole copy replaces the striped version
+    store.record_layout('u/c', LAYOUT)
+    assert (tmp_path / 'snapshot.json').exists()
+    assert len((tmp_path / 'wal.log').read_text().splitlines()) == 3
+
+    restarted = recovered(tmp_path, snapshot_every=4)
+    assert restarted.file_locations == {'u/a': {'s1'}, 'u/b': {'s2'}, 'u/d': {'s2'}}
+    assert restarted.file_layouts == {'u/c': LAYOUT}
+    assert {server: data['files'] for server, data in restarted.servers.items()} == \
+        {'s1': {'u/a'}, 's2': {'u/b', 'u/d'}}
+
+def test_replaying_entries_already_in_the_snapshot_changes_nothing(tmp_path):
+    store = recovered(tmp_path)
+    store.register_server('s1', ['u/a'])
+    store.record_file('s1', 'u/b')
+    store.drop_file('s1', 'u/a')
+    log = (tmp_path / 'wal.log').read_text()
+    store.write_snapshot()
+    # A crash between writing the snapshot and truncating the log
+    (tmp_path / 'wal.log').write_text(log)
+
+    assert recovered(tmp_path).file_locations == {'u/b': {'s1'}}
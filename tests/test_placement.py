@@ -0,0 +1,41 @@
+""" Placement of files on the consistent-hash ring. """
+
+
+from placement import HashRing, file_key
+
+KEYS = [file_key('user', f'file{number}') for number in range(10000)]
+
+def owners(ring):
+    return {key: ring.nodes_for(key)[0] for key in KEYS}
+
+def test_adding_a_node_only_moves_keys_to_it():
+    ring = HashRing()
+    for node in ('s1', 's2', 's3'):
+        ring.add(node)
+    before = owners(ring)
+    ring.add('s4')
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == 's4' for key in moved)
+    # About a quarter of the keys, not a reshuffle of all of them
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+def test_removing_a_node_restores_the_previous_owners():
+    ring = HashRing()
+    for node in ('s1', 's2', 's3'):
+        ring.add(node)
+    before = owners(ring)
+    ring.add('s4')
+    ring.remove('s4')
+    assert owners(ring) == before
+
+def test_replicas_are_distinct_and_start_at_the_owner():
+    ring = HashRing()
+    for node in ('s1', 's2', 's3'):
+        ring.add(node)
+    for key in KEYS[:100]:
+        replicas = ring.nodes_for(key, 3)
+        assert sorted(replicas) == ['s1', 's2', 's3']
+        assert replicas[0] == ring.nodes_for(key)[0]
+    assert len(ring.nodes_for(KEYS[0], 5)) == 3
@@ -0,0 +1,23 @@
+""" Validation of the names the storage backends turn into paths. """
+
+
+import pytest
+
+from stores import FileStore, check_name
+
+@pytest.mark.parametrize('name', ['', '.', '..', '../etc', 'a/b', '/abs', 'a\\b', 'a\0b', None, 3])
+def test_check_name_rejects_unsafe_names(name):
+    with pytest.raises(ValueError):
+        check_name(name)
+
+@pytest.mark.parametrize('name', ['file.txt', '.file.txt.stripe0', '..hidden', 'a b'])
+def test_check_name_accepts_single_components(name):
+    assert check_name(name) == name
+
+def test_file_store_rejects_escaping_names(tmp_path):
+    store = FileStore(str(tmp_path / 'content'))
+    with pytest.raises(ValueError):
+        store.begin_put('..', 'file.txt')
+    with pytest.raises(ValueError):
+        store.begin_put('user', '../../outside')
+    assert not (tmp_path / 'outside').exists()